@@ -8,6 +8,9 @@ The following more specialized modules can be accessed directly if necessary:
  - state provides State, which represents a Mit instance.
  - assembler provides Assembler.
  - disassembler provides Disassembler.
+ - verifier verifies code for `run_verified`.
+ - memory provides Memory, and `file_mapping()` for file-backed memory.
+ - batch runs many States at once.
  - globals provides a convenient set of functions and variables to
    interact with Mit in a Python REPL.
 
@@ -23,17 +26,53 @@ provides a global Mit instance in VM, and defines various globals. See
 `State.globalize()` for details.
 '''
 
-from .enums import (
-    Registers, Instructions, TERMINAL_OPCODES, ExtraInstructions,
-    MitErrorCode
-)
-from .trap_enums import LibC, LibInstructions
-from .binding import (
-    Error, VMError,
-    c_uword, c_word, uword_max,
-    word_bytes, word_bit, sign_bit,
-    is_aligned, register_args,
-)
-from .state import State
-from .assembler import Assembler
-from .disassembler import Disassembler
+import importlib
+
+# The names provided by the package, by module. Each module is imported
+# when one of its names is first used, so that importing the package is
+# fast.
+_exports = {
+    'enums': [
+        'Registers', 'Instructions', 'TERMINAL_OPCODES', 'ExtraInstructions',
+        'MitErrorCode',
+    ],
+    'trap_enums': ['LibC', 'LibInstructions'],
+    'binding': [
+        'Error', 'VMError',
+        'c_uword', 'c_word', 'uword_max',
+        'word_bytes', 'word_bit', 'sign_bit',
+        'is_aligned', 'register_args',
+    ],
+    'state': ['State'],
+    'assembler': ['Assembler'],
+    'disassembler': ['Disassembler'],
+}
+_modules = {
+    name: module
+    for module, names in _exports.items()
+    for name in names
+}
+__all__ = list(_modules)
+
+
+def __getattr__(name):
+    '''
+    Import the module that provides `name`, or the submodule `name`.
+    '''
+    module = _modules.get(name)
+    if module is None:
+        if name.startswith('__'):
+            raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+        try:
+            return importlib.import_module(f'.{name}', __name__)
+        except ModuleNotFoundError as e:
+            if e.name != f'{__name__}.{name}':
+                raise
+            raise AttributeError(f"module '{__name__}' has no attribute '{name}'") from None
+    value = getattr(importlib.import_module(f'.{module}', __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,195 @@
+'''
+Run many VMs at once.
+
+(c) Mit authors 2020
+
+The package is distributed under the MIT/X11 License.
+
+THIS PROGRAM IS PROVIDED AS IS, WITH NO WARRANTY. USE IS AT THE USER’S
+RISK.
+'''
+
+import itertools
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed,
+    wait
+)
+from ctypes import addressof
+from dataclasses import dataclass
+
+from .binding import VMError, register_args, run_count, run_fns, thread_locals
+from .state import State
+
+
+def run_threads(states, max_workers=None, **kwargs):
+    '''
+    Run each State in `states` with `State.run(**kwargs)` in a pool of
+    threads. libmit does not hold the GIL, so the States run in parallel,
+    each with its own `run_fn`, `stack_words` and `break_fn`. If libmit has
+    no thread-local storage, they run one at a time (see `State`).
+
+    Yields a pair `(state, error)` as each run finishes, where `error` is
+    the exception raised by the run, or `None`.
+
+     - states - iterable of State - the States, which must be distinct.
+     - max_workers - optional int - the number of threads, defaulting to
+       that of `concurrent.futures.ThreadPoolExecutor`.
+    '''
+    with ThreadPoolExecutor(max_workers) as executor:
+        futures = {executor.submit(state.run, **kwargs): state for state in states}
+        for future in as_completed(futures):
+            yield futures[future], future.exception()
+
+
+@dataclass
+class Result:
+    '''
+    The result of a run made by `run_processes()`.
+
+     - index - int - the index of the run's arguments in `inputs`.
+     - args - list of str - the arguments.
+     - exit_code - int - the exit code, as for the `mit` program: 0 if the
+       run finished normally, the code thrown by the program, or
+       `127 - code` for a VM error `code`.
+     - stdout - bytes - what the run wrote to file descriptor 1.
+     - instructions - int or None - the number of instructions executed,
+       if counted.
+     - time - float - the wall-clock time of the run in seconds.
+    '''
+    index: int
+    args: list
+    exit_code: int
+    stdout: bytes
+    instructions: int
+    time: float
+
+
+class _Worker:
+    '''
+    The State of a worker process of `run_processes()`, with the image
+    loaded, and a snapshot of it from which to start each run.
+    '''
+    def __init__(self, object_file, memory_words, stack_words, run_fn):
+        self.object_file = object_file
+        self.state = State(memory_words, stack_words=stack_words, run_fn=run_fn)
+        # Instructions are counted if the engine is `run_count`, whether it
+        # is given by name or not.
+        if isinstance(run_fn, str):
+            run_fn = run_fns.get(run_fn)
+        self.counting = (
+            run_fn is not None and addressof(run_fn) == addressof(run_count)
+        )
+        self.state.load(object_file)
+        self.snapshot = self.state.snapshot()
+        self.output = tempfile.TemporaryFile()
+
+    def run(self, index, args):
+        state = self.state
+        state.restore(self.snapshot)
+        register_args(self.object_file, *args)
+        instruction_count = thread_locals.instruction_count
+        instruction_count.value = 0
+        output = self.output
+        output.seek(0)
+        output.truncate()
+        # Capture file descriptor 1, which the VM writes to directly.
+        sys.stdout.flush()
+        saved_stdout = os.dup(1)
+        os.dup2(output.fileno(), 1)
+        start = time.perf_counter()
+        try:
+            state.run()
+            exit_code = 0
+        except VMError as e:
+            exit_code = e.args[0]
+            if -127 <= exit_code < 0:
+                exit_code = 127 - exit_code
+        finally:
+            elapsed = time.perf_counter() - start
+            os.dup2(saved_stdout, 1)
+            os.close(saved_stdout)
+        output.seek(0)
+        return Result(
+            index,
+            args,
+            exit_code,
+            output.read(),
+            instruction_count.value if self.counting else None,
+            elapsed,
+        )
+
+_worker = None
+
+def _init_worker(*args):
+    global _worker
+    _worker = _Worker(*args)
+
+def _run_in_worker(chunk):
+    return [_worker.run(index, args) for index, args in chunk]
+
+
+def run_processes(
+        object_file,
+        inputs,
+        max_workers=None,
+        memory_words=1024*1024,
+        stack_words=None,
+        run_fn='count',
+        chunksize=1,
+):
+    '''
+    Run the image in `object_file` once for each list of arguments in
+    `inputs`, in a pool of processes.
+
+    Each worker process loads the image once, with `State.load()`, which
+    maps the file copy-on-write, so that the workers share the pages of the
+    image that they do not write. Each run starts from a snapshot taken
+    after loading, and its arguments are registered after the name of
+    `object_file`, as by the `mit` program.
+
+    Yields a Result for each run as it finishes, or for each chunk of runs,
+    which may not be in the order of `inputs`. At most two chunks per
+    worker are waiting or running at once, and `inputs` is read as they
+    finish, so it may be a long or endless iterator.
+
+     - object_file - str - the image to run.
+     - inputs - iterable of lists of str - the arguments of each run.
+     - max_workers - optional int - the number of processes, defaulting to
+       that of `concurrent.futures.ProcessPoolExecutor`.
+     - memory_words - optional int - the size of each worker's memory.
+     - stack_words - optional int - the size of each worker's stack.
+     - run_fn - optional str - the name of the engine to use in
+       `binding.run_fns`. The number of instructions is only counted with
+       the default, 'count'.
+     - chunksize - optional int - the number of runs to send to a worker
+       at once. Larger chunks reduce the overhead per run, but delay the
+       results.
+    '''
+    with ProcessPoolExecutor(
+            max_workers,
+            initializer=_init_worker,
+            initargs=(object_file, memory_words, stack_words, run_fn),
+    ) as executor:
+        inputs = iter(enumerate(inputs))
+        max_pending = 2 * (max_workers or os.cpu_count() or 1)
+        pending = set()
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < max_pending:
+                chunk = [
+                    (index, list(args))
+                    for index, args in itertools.islice(inputs, chunksize)
+                ]
+                if len(chunk) == 0:
+                    exhausted = True
+                else:
+                    pending.add(executor.submit(_run_in_worker, chunk))
+            if len(pending) == 0:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield from future.result()
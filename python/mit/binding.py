@@ -9,23 +9,45 @@ THIS PROGRAM IS PROVIDED AS IS, WITH NO WARRANTY. USE IS AT THE USER’S
 RISK.
 '''
 
+import os
+import threading
 from ctypes import (
-    CDLL, CFUNCTYPE, POINTER, c_char_p, c_int, c_size_t, c_ssize_t, c_void_p,
-    pointer, sizeof
+    CDLL, CFUNCTYPE, POINTER, Structure, c_char_p, c_int, c_int64, c_size_t,
+    c_ssize_t, c_void_p, get_errno, pointer, sizeof
 )
-from ctypes.util import find_library
 
 from .enums import MitErrorCode, Registers
 
-library_file = find_library("mit")
-if not library_file:
-    # For Windows
-    # TODO: Do this portably
-    # TODO: Substitute version when library is versioned
-    library_file = find_library("libmit-0")
-assert(library_file)
-libmit = CDLL(library_file)
-assert(libmit)
+# The file names of libmit on Linux and other ELF systems, macOS, and
+# Windows.
+# TODO: Substitute version when library is versioned
+LIBRARY_NAMES = ['libmit.so.0', 'libmit.0.dylib', 'libmit-0.dll']
+
+def load_libmit():
+    '''
+    Load libmit from the file named by the environment variable
+    `MIT_LIBRARY`, if it is set. Otherwise, try each of `LIBRARY_NAMES`,
+    which the dynamic linker can find directly, and then fall back to
+    `ctypes.util.find_library()`, which is much slower, as it runs
+    `ldconfig` or a compiler on some platforms.
+    '''
+    library_file = os.environ.get('MIT_LIBRARY')
+    if library_file is not None:
+        return CDLL(library_file, use_errno=True)
+    for name in LIBRARY_NAMES:
+        try:
+            return CDLL(name, use_errno=True)
+        except OSError:
+            pass
+    from ctypes.util import find_library
+    library_file = find_library("mit")
+    if not library_file:
+        # For Windows
+        library_file = find_library("libmit-0")
+    assert(library_file)
+    return CDLL(library_file, use_errno=True)
+
+libmit = load_libmit()
 
 
 # Errors
@@ -84,6 +106,49 @@ c_mit_fn = CFUNCTYPE(
     POINTER(c_word), c_word, POINTER(c_word), c_uword, POINTER(c_uword),
 )
 
+class c_verified_word(Structure):
+    '''
+    `mit_verified_word_t`.
+    '''
+    _fields_ = [('ir', c_word), ('pops', c_uword), ('pushes', c_uword)]
+
+class c_context(Structure):
+    '''
+    `mit_context_t`.
+    '''
+    _fields_ = [
+        ('pc', POINTER(c_word)),
+        ('ir', c_word),
+        ('stack', POINTER(c_word)),
+        ('stack_words', c_uword),
+        ('stack_depth', c_uword),
+        ('interrupt', c_int),
+        ('frames', c_void_p),
+    ]
+
+class c_trace_entry(Structure):
+    '''
+    `mit_trace_entry_t`.
+    '''
+    _fields_ = [
+        ('pc', c_void_p),
+        ('ir', c_word),
+        ('opcode', c_uword),
+        ('depth', c_uword),
+        ('stack', c_word * 2), # MIT_TRACE_STACK_ITEMS
+    ]
+
+class c_watch_hit(Structure):
+    '''
+    `mit_watch_hit_t`.
+    '''
+    _fields_ = [
+        ('pc', c_void_p),
+        ('addr', c_void_p),
+        ('old_value', c_word),
+        ('new_value', c_word),
+    ]
+
 # Constants
 word_bytes = sizeof(c_uword)
 assert word_bytes in (4, 8), f"word_bytes must be 4 or 8 and is {word_bytes}!"
@@ -98,29 +163,184 @@ uword_max = c_uword(-1).value
 # Errors
 mit_error = errcheck(MitErrorCode)
 
-# Bind `mit_run` as a function and as a function pointer, because
-# for some reason we can't call it when bound as a pointer.
-_run = c_mit_fn.in_dll(libmit, "mit_run")
-run_ptr = POINTER(c_mit_fn).in_dll(libmit, "mit_run")
-# `break_fn_ptr` must be bound as a `c_void_p` in order to be set to point
-# to a Python callback.
-break_fn_ptr = c_void_p.in_dll(libmit, "mit_break_fn")
-stack_words_ptr = pointer(c_uword.in_dll(libmit, "mit_stack_words"))
-stack_words = c_uword.in_dll(libmit, "mit_stack_words")
+# True if each thread has its own `MIT_THREAD_LOCAL` variables; otherwise,
+# they are shared by all threads.
+thread_local = c_int.in_dll(libmit, "mit_thread_local").value != 0
+
+class ThreadLocals(threading.local):
+    '''
+    The calling thread's instances of the `MIT_THREAD_LOCAL` variables of
+    libmit. `in_dll()` finds the instance of the thread that calls it, so
+    each thread binds a variable the first time it uses it.
+
+    The attributes have the same names as the module-level bindings, which
+    are the instances of the thread that imported this module.
+    '''
+    _variables = {
+        # Bind `mit_run` as a function and as a function pointer, because
+        # for some reason we can't call it when bound as a pointer.
+        '_run': (c_mit_fn, "mit_run"),
+        'run_ptr': (POINTER(c_mit_fn), "mit_run"),
+        # `break_fn_ptr` must be bound as a `c_void_p` in order to be set to
+        # point to a Python callback.
+        'break_fn_ptr': (c_void_p, "mit_break_fn"),
+        'break_steps': (c_uword, "mit_break_steps"),
+        'breakpoints_pc': (c_void_p, "mit_breakpoints_pc"),
+        'breakpoints_length': (c_uword, "mit_breakpoints_length"),
+        'breakpoints': (c_void_p, "mit_breakpoints"),
+        'break_error_pc': (c_void_p, "mit_break_error_pc"),
+        'stack_words': (c_uword, "mit_stack_words"),
+        'max_call_depth': (c_uword, "mit_max_call_depth"),
+        'instruction_count': (c_uword, "mit_instruction_count"),
+        'trace_buffer': (c_void_p, "mit_trace_buffer"),
+        'trace_length': (c_uword, "mit_trace_length"),
+        'trace_count': (c_uword, "mit_trace_count"),
+        'watch_addrs': (c_void_p, "mit_watch_addrs"),
+        'watch_length': (c_uword, "mit_watch_length"),
+        'watch_hits': (c_void_p, "mit_watch_hits"),
+        'watch_hits_length': (c_uword, "mit_watch_hits_length"),
+        'watch_hits_count': (c_uword, "mit_watch_hits_count"),
+        'verified_pc': (c_void_p, "mit_verified_pc"),
+        'verified_length': (c_uword, "mit_verified_length"),
+        'verified_table': (c_void_p, "mit_verified_table"),
+    }
+
+    def __getattr__(self, name):
+        try:
+            c_type, symbol = self._variables[name]
+        except KeyError:
+            raise AttributeError(name)
+        variable = c_type.in_dll(libmit, symbol)
+        setattr(self, name, variable)
+        return variable
+
+thread_locals = ThreadLocals()
+
+_run = thread_locals._run
+run_ptr = thread_locals.run_ptr
+break_fn_ptr = thread_locals.break_fn_ptr
+break_steps = thread_locals.break_steps
+breakpoints_pc = thread_locals.breakpoints_pc
+breakpoints_length = thread_locals.breakpoints_length
+breakpoints = thread_locals.breakpoints
+break_error_pc = thread_locals.break_error_pc
+stack_words = thread_locals.stack_words
+stack_words_ptr = pointer(stack_words)
+max_call_depth = thread_locals.max_call_depth
+instruction_count = thread_locals.instruction_count
+trace_buffer = thread_locals.trace_buffer
+trace_length = thread_locals.trace_length
+trace_count = thread_locals.trace_count
+watch_addrs = thread_locals.watch_addrs
+watch_length = thread_locals.watch_length
+watch_hits = thread_locals.watch_hits
+watch_hits_length = thread_locals.watch_hits_length
+watch_hits_count = thread_locals.watch_hits_count
+verified_pc = thread_locals.verified_pc
+verified_length = thread_locals.verified_length
+verified_table = thread_locals.verified_table
+
 run_simple = c_mit_fn.in_dll(libmit, "mit_run_simple")
+run_cached = c_mit_fn.in_dll(libmit, "mit_run_cached")
+run_super = c_mit_fn.in_dll(libmit, "mit_run_super")
+run_verified = c_mit_fn.in_dll(libmit, "mit_run_verified")
+run_guarded = c_mit_fn.in_dll(libmit, "mit_run_guarded")
 run_break = c_mit_fn.in_dll(libmit, "mit_run_break")
-# run_fast = c_mit_fn.in_dll(libmit, "mit_run_fast")
-# run_profile = c_mit_fn.in_dll(libmit, "mit_run_profile")
+run_count = c_mit_fn.in_dll(libmit, "mit_run_count")
+run_trace = c_mit_fn.in_dll(libmit, "mit_run_trace")
+run_watch = c_mit_fn.in_dll(libmit, "mit_run_watch")
+
+# `mit_run_fast` and `mit_run_profile` are defined only when libmit is
+# built with the specializer; otherwise they are `None`.
+def optional_run_fn(name):
+    try:
+        return c_mit_fn.in_dll(libmit, name)
+    except ValueError:
+        return None
+
+run_fast = optional_run_fn("mit_run_fast")
+run_profile = optional_run_fn("mit_run_profile")
+
+# The available implementations of `mit_run`, by name.
+run_fns = {
+    name: fn for name, fn in (
+        ('simple', run_simple),
+        ('cached', run_cached),
+        ('super', run_super),
+        ('verified', run_verified),
+        ('guarded', run_guarded),
+        ('break', run_break),
+        ('count', run_count),
+        ('trace', run_trace),
+        ('watch', run_watch),
+        ('fast', run_fast),
+        ('profile', run_profile),
+    )
+    if fn is not None
+}
 
 
 # Cannot add errcheck to a CFUNCTYPE, so wrap it manually.
 def run(pc, ir, stack, stack_words, stack_depth_ptr):
-    return mit_error(_run(pc, ir, stack, stack_words, stack_depth_ptr))
+    '''
+    Call the calling thread's `mit_run`.
+    '''
+    return mit_error(thread_locals._run(pc, ir, stack, stack_words, stack_depth_ptr))
+
+libmit.mit_run_fuel.restype = c_word
+libmit.mit_run_fuel.argtypes = [POINTER(c_context), POINTER(c_uword)]
+run_fuel = libmit.mit_run_fuel
 
-# libmit.mit_profile_reset.restype = None
-# libmit.mit_profile_reset.argtypes = None
+libmit.mit_context_reset.restype = None
+libmit.mit_context_reset.argtypes = [POINTER(c_context)]
+context_reset = libmit.mit_context_reset
 
-# libmit.mit_profile_dump.argtypes = [c_int]
+def oserror_check(result, func, args):
+    '''
+    `ctypes._FuncPtr.errcheck` callback for functions that return -1 and set
+    `errno` on error.
+    '''
+    if result == -1:
+        errno = get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return result
+
+libmit.mit_load_file.restype = c_int
+# Mit is built with large file support, so `off_t` has 64 bits.
+libmit.mit_load_file.argtypes = [c_int, c_int64, c_size_t, c_void_p]
+libmit.mit_load_file.errcheck = oserror_check
+load_file = libmit.mit_load_file
+
+libmit.mit_restore_pages.restype = c_size_t
+libmit.mit_restore_pages.argtypes = [c_void_p, c_void_p, c_size_t, c_size_t, c_void_p]
+restore_pages = libmit.mit_restore_pages
+
+if run_profile is not None:
+    libmit.mit_profile_reset.restype = None
+    libmit.mit_profile_reset.argtypes = []
+    profile_reset = libmit.mit_profile_reset
+
+    libmit.mit_profile_dump.restype = c_int
+    libmit.mit_profile_dump.argtypes = [c_int]
+    libmit.mit_profile_dump.errcheck = oserror_check
+    profile_dump = libmit.mit_profile_dump
+else:
+    profile_reset = profile_dump = None
+
+def profile_labels():
+    '''
+    Return the profile recorded by `mit_run_profile` on the current thread,
+    as a list of dicts, one per label of the specialized interpreter, with
+    the keys of the objects written by `mit_profile_dump()`: 'path',
+    'guess', 'if_correct', 'if_wrong', 'correct_count' and 'wrong_count'.
+    '''
+    if profile_dump is None:
+        raise Error("libmit was built without the specializer")
+    import json, tempfile
+    with tempfile.TemporaryFile('w+') as h:
+        profile_dump(h.fileno())
+        h.seek(0)
+        return json.load(h)
 
 
 def is_aligned(addr):
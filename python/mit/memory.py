@@ -9,16 +9,78 @@ THIS PROGRAM IS PROVIDED AS IS, WITH NO WARRANTY. USE IS AT THE USER’S
 RISK.
 '''
 
-from ctypes import addressof
+import mmap
+import os
+import re
+import sys
+from ctypes import addressof, c_char
 
-from .binding import uword_max, word_bytes
+from .binding import Error, c_uword, load_file, uword_max, word_bytes
+
+
+# memoryview formats for elements of each size and signedness.
+FORMATS = {
+    (1, False): 'B',
+    (1, True): 'b',
+    (word_bytes, False): 'N',
+    (word_bytes, True): 'n',
+}
+
+
+def file_mapping(filename, shared=False, memory_words=None):
+    '''
+    Map the file `filename`, for use as the memory of a `State`. The length
+    of the file must be a whole number of words, not including any "#!"
+    line, which is skipped.
+
+     - shared - bool - if false, the mapping is private and copy-on-write:
+       writes do not change the file, and pages that have not been written
+       are shared with other processes that map the same file. If true,
+       writes change the file, and are seen by other processes that map it.
+     - memory_words - int - the length of the mapping in words, which
+       defaults to the length of the file. Memory beyond the end of the file
+       is zero.
+
+    A shared mapping must be the whole of a file without a "#!" line. A
+    private mapping of a file with a "#!" line, or that is larger than the
+    file, is anonymous memory that the file is loaded into, as by
+    `State.load()`.
+    '''
+    with open(filename, 'r+b' if shared else 'rb') as h:
+        # Skip any #! line.
+        if h.read(2) == b'#!':
+            h.readline()
+        else:
+            h.seek(0)
+        offset = h.tell()
+        length = os.fstat(h.fileno()).st_size - offset
+        if length % word_bytes != 0:
+            raise Error(f"file '{filename}' is not a whole number of words")
+        size = length if memory_words is None else memory_words * word_bytes
+        if length > size:
+            raise Error(f"file '{filename}' is longer than {memory_words} words")
+        if offset == 0 and size == length:
+            return mmap.mmap(
+                h.fileno(), size,
+                access=mmap.ACCESS_WRITE if shared else mmap.ACCESS_COPY,
+            )
+        if shared:
+            raise Error(f"a shared mapping must be the whole of file '{filename}' without a #! line")
+        memory = mmap.mmap(-1, size)
+        buffer = (c_char * size).from_buffer(memory)
+        try:
+            load_file(h.fileno(), offset, length, addressof(buffer))
+        finally:
+            del buffer
+        return memory
 
 
 class Memory:
     '''
     A writable byte- or word-addressed view of a block of memory.
 
-     - buffer - a value returned by ctypes.create_string_buffer - the memory.
+     - buffer - a ctypes array of c_char, such as a value returned by
+       ctypes.create_string_buffer - the memory.
      - element_size - int - the number of bytes read/written at a time.
      - view - the underlying memoryview.
      - start - int - the start address of the memory.
@@ -32,12 +94,18 @@ class Memory:
     `element_size`, i.e. only the valid addresses will be accessed.
 
     `len()` gives the number of elements.
+
+    Bulk operations work on whole ranges of memory at memcpy speed:
+    `read_bytes()`, `read_words()`, `write_words()`, `fill()` and `find()`.
+    `cast()` gives a zero-copy view of the whole memory, which can be passed
+    to `numpy.asarray()` to get a NumPy array sharing the memory.
     '''
     def __init__(self, buffer, element_size=1):
         self.buffer = buffer
         assert element_size in (1, word_bytes)
         self.element_size = element_size
         self.view = memoryview(self.buffer).cast('B')
+        self._bytes = self.view
         if element_size == word_bytes:
             self.view = self.view.cast('N')
         self.start = addressof(self.buffer)
@@ -70,3 +138,86 @@ class Memory:
         if not isinstance(value, bytes):
             value = int(value) & uword_max
         self.view.__setitem__(self._address_to_index(addr), value)
+
+    def cast(self, element_size=1, signed=False):
+        '''
+        Return a memoryview of the whole memory with elements of
+        `element_size` bytes (1 or `word_bytes`), signed or unsigned.
+        '''
+        return self._bytes.cast(FORMATS[(element_size, signed)])
+
+    def _element_bytes(self, value):
+        mask = (1 << (self.element_size * 8)) - 1
+        return (int(value) & mask).to_bytes(self.element_size, sys.byteorder)
+
+    def _byte_range(self, start, end):
+        if start is None:
+            start = self.start
+        if end is None:
+            end = self.end
+        if not self.start <= start <= end <= self.end:
+            raise IndexError(start, end)
+        return self._bytes[start - self.start:end - self.start]
+
+    def read_bytes(self, addr, length):
+        '''
+        Return a memoryview of `length` bytes from `addr`, sharing memory.
+        '''
+        return self._byte_range(addr, addr + length)
+
+    def read_words(self, addr, length, signed=False):
+        '''
+        Return a memoryview of `length` words from `addr`, which must be
+        aligned, sharing memory.
+        '''
+        assert addr % word_bytes == 0
+        return self._byte_range(addr, addr + length * word_bytes).cast(
+            FORMATS[(word_bytes, signed)]
+        )
+
+    def write_words(self, addr, values):
+        '''
+        Write words from `addr`, which must be aligned. `values` is either
+        an object supporting the buffer protocol, whose bytes are copied, or
+        an iterable of int.
+        '''
+        assert addr % word_bytes == 0
+        try:
+            data = memoryview(values).cast('B')
+        except TypeError:
+            values = list(values)
+            data = memoryview((c_uword * len(values))(
+                *(int(value) & uword_max for value in values)
+            )).cast('B')
+        self._byte_range(addr, addr + len(data))[:] = data
+
+    def fill(self, value, start=None, end=None):
+        '''
+        Set each element from `start` to `end` to `value`. `start` and
+        `end` default to the start and end of the memory.
+        '''
+        view = self._byte_range(start, end)
+        assert len(view) % self.element_size == 0
+        element = self._element_bytes(value)
+        view[:] = element * (len(view) // self.element_size)
+
+    def find(self, value, start=None, end=None):
+        '''
+        Return the address of the first element from `start` to `end` equal
+        to `value`, or `None` if there is none. `start` and `end` default to
+        the start and end of the memory.
+        '''
+        if start is None:
+            start = self.start
+        view = self._byte_range(start, end)
+        element = self._element_bytes(value)
+        pattern = re.compile(re.escape(element))
+        pos = 0
+        while True:
+            match = pattern.search(view, pos)
+            if match is None:
+                return None
+            addr = start + match.start()
+            if addr % self.element_size == 0:
+                return addr
+            pos = match.start() + 1
@@ -0,0 +1,151 @@
+'''
+Snapshots of VM state.
+
+(c) Mit authors 2020
+
+The package is distributed under the MIT/X11 License.
+
+THIS PROGRAM IS PROVIDED AS IS, WITH NO WARRANTY. USE IS AT THE USER’S
+RISK.
+'''
+
+import mmap
+import struct
+import threading
+import weakref
+from contextlib import contextmanager
+from ctypes import addressof, c_char, c_ubyte
+
+from .binding import c_word
+
+
+class Snapshot:
+    '''
+    A copy of the memory, stack and `pc` of a State, made by
+    `State.snapshot()`.
+    '''
+    def __init__(self, state):
+        self.start = state.M.start
+        self.memory = (c_char * len(state.M)).from_buffer_copy(state.M.view)
+        self.stack = (c_word * len(state.stack)).from_buffer_copy(state.stack)
+        self.pc = state.pc
+
+
+# Soft-dirty bits are bit 55 of the entries of /proc/self/pagemap.
+SOFT_DIRTY = 1 << 55
+
+# The trackers that are currently in use.
+_trackers = weakref.WeakSet()
+# Held while soft-dirty bits are collected and cleared, and while `_running`
+# is changed.
+_lock = threading.Lock()
+# The number of States that are running.
+_running = 0
+
+
+@contextmanager
+def running():
+    '''
+    A context manager that counts a State as running while it is entered,
+    for `DirtyTracker.clear()`.
+    '''
+    global _running
+    with _lock:
+        _running += 1
+    try:
+        yield
+    finally:
+        with _lock:
+            _running -= 1
+
+
+class DirtyTracker:
+    '''
+    Track the pages of memory written in a range of addresses, using the
+    soft-dirty bits of Linux (see the kernel documentation in
+    admin-guide/mm/soft-dirty.rst).
+
+    Clearing soft-dirty bits clears them for the whole process, so each
+    tracker collects the bits for its range before any tracker clears them.
+    Trackers do this one at a time, but a page written by another thread
+    between the collecting and the clearing is missed. Therefore, if a State
+    is running (see `running()`) when a tracker clears the bits, the other
+    trackers are no longer trusted: `dirty_bitmap()` returns `None` until
+    they are next cleared, so that every page is compared.
+
+     - start - int - the start address of the range.
+     - end - int - the end address of the range.
+     - available - bool - true if soft-dirty bits are available. If not,
+       `dirty_bitmap()` always returns `None`.
+    '''
+    available = None
+
+    def __init__(self, start, end):
+        self.first_page = start // mmap.PAGESIZE
+        self.pages = (end + mmap.PAGESIZE - 1) // mmap.PAGESIZE - self.first_page
+        self._dirty = set()
+        self._missed = False
+        if DirtyTracker.available is None:
+            DirtyTracker.available = self._probe()
+        _trackers.add(self)
+
+    @staticmethod
+    def _clear_refs():
+        with open('/proc/self/clear_refs', 'w') as h:
+            h.write('4')
+
+    @staticmethod
+    def _read_pagemap(first_page, pages):
+        with open('/proc/self/pagemap', 'rb') as h:
+            h.seek(first_page * 8)
+            return struct.unpack(f'{pages}Q', h.read(pages * 8))
+
+    @staticmethod
+    def _probe():
+        '''
+        Test whether soft-dirty bits are available, by writing to a page.
+        '''
+        try:
+            page = mmap.mmap(-1, mmap.PAGESIZE)
+            buffer = (c_char * mmap.PAGESIZE).from_buffer(page)
+            first_page = addressof(buffer) // mmap.PAGESIZE
+            DirtyTracker._clear_refs()
+            buffer[0] = b'x'
+            entry, = DirtyTracker._read_pagemap(first_page, 1)
+            return entry & SOFT_DIRTY != 0
+        except OSError:
+            return False
+
+    def _collect(self):
+        entries = self._read_pagemap(self.first_page, self.pages)
+        self._dirty.update(i for i, entry in enumerate(entries) if entry & SOFT_DIRTY)
+
+    def clear(self):
+        '''
+        Start tracking afresh.
+        '''
+        if self.available:
+            with _lock:
+                for tracker in _trackers:
+                    if tracker is not self:
+                        tracker._collect()
+                        if _running > 0:
+                            tracker._missed = True
+                self._clear_refs()
+        self._dirty = set()
+        self._missed = False
+
+    def dirty_bitmap(self):
+        '''
+        Return a bitmap of the pages written since `clear()`, suitable for
+        `mit_restore_pages()`, or `None` if soft-dirty bits are not
+        available, or some writes may have been missed.
+        '''
+        if not self.available or self._missed:
+            return None
+        with _lock:
+            self._collect()
+        bitmap = (c_ubyte * ((self.pages + 7) // 8))()
+        for i in self._dirty:
+            bitmap[i // 8] |= 1 << (i % 8)
+        return bitmap
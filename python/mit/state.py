@@ -9,21 +9,38 @@ THIS PROGRAM IS PROVIDED AS IS, WITH NO WARRANTY. USE IS AT THE USER’S
 RISK.
 '''
 
+import contextlib
+import mmap
+import os
+import shutil
 import sys
-from ctypes import POINTER, byref, c_void_p, cast, create_string_buffer
+import tempfile
+import threading
+from ctypes import (
+    POINTER, addressof, byref, c_char, c_ubyte, c_void_p, cast, memmove,
+    pointer, sizeof
+)
 from dataclasses import dataclass
 from types import FunctionType
 
 from . import enums
 from .assembler import Assembler
-# from .binding import run_fast
 from .binding import (
-    Error, VMError, break_fn_ptr, c_mit_fn, c_uword, c_word, hex0x_word_width,
-    is_aligned, register_args, run, run_break, run_ptr, run_simple,
-    stack_words, uword_max, word_bytes
+    Error, VMError, c_context, c_mit_fn, c_trace_entry, c_uword, c_watch_hit,
+    c_word, context_reset, hex0x_word_width, is_aligned, load_file,
+    mit_error, register_args, restore_pages, run, run_break, run_fns,
+    run_fuel, run_simple, thread_local, thread_locals, uword_max, word_bytes
 )
 from .disassembler import Disassembler
 from .memory import Memory
+from .snapshot import DirtyTracker, Snapshot, running
+from .verifier import verify
+
+
+# Without thread-local storage, the variables that `run()` sets are shared
+# by all threads, so runs are made one at a time. The lock is reentrant, so
+# that a `break_fn` can run another State.
+_run_lock = contextlib.nullcontext() if thread_local else threading.RLock()
 
 
 class State:
@@ -33,59 +50,268 @@ class State:
      - pc - the initial value of `pc` used by `step()` and `run()`.
      - M - Memory - a byte view of some memory.
      - M_word - Memory - a word view of the same memory as `M`.
+     - context - c_context - the native context used by `run()`, which owns
+       the stack. It is reused by each run, so that the stack can be
+       inspected after a run, and kept for the next one.
+     - run_fn - c_mit_fn or str - the default `run_fn` of `run()`.
+     - stack_words - int or None - the capacity of the stack in words, or
+       `None` to use `mit_stack_words` of the thread that runs the State.
+     - break_fn - function or None - a `mit_fn_t`-like function for
+       `run_break` to call. See BreakHandler.
+
+    `run()` sets `mit_run`, `mit_stack_words` and `mit_break_fn` from these
+    attributes, and the `mit_verified_...` variables from the code verified
+    by `verify()`, on the thread that calls it, and restores them
+    afterwards, so States may be run concurrently in different threads.
+    Tracing and watching use variables of the thread that sets them up.
+
+    If libmit has no thread-local storage (`binding.thread_local` is false),
+    these variables are shared by all threads, so `run()` runs one State at
+    a time, and stepping, tracing and watching must only be used while no
+    State is running in another thread. `run_async()` does not wait for
+    other runs, but `catch` in the code it runs may then use `mit_run` of a
+    run in another thread.
     '''
-    def __init__(self, memory_words=1024*1024, args=None):
+    def __init__(self, memory_words=1024*1024, args=None, memory=None, run_fn=run_simple, stack_words=None):
         '''
         Create the VM state.
 
          - memory_words - optional int - number of words of main memory to
            allocate. The VM can use other memory, but the block of memory
-           allocated can be accessed conveniently from Python.
+           allocated can be accessed conveniently from Python. The memory is
+           anonymous memory mapped with `mmap`, so pages are only allocated
+           when they are used.
          - args - optional list of str - command-line arguments to register.
+         - run_fn - optional c_mit_fn or str - see above.
+         - stack_words - optional int - see above.
+         - memory - optional writable buffer - memory to use instead of
+           allocating `memory_words` words, such as a mapping returned by
+           `memory.file_mapping()`, or the `buf` of a
+           `multiprocessing.shared_memory.SharedMemory`. Its length must be
+           a whole number of words.
         '''
-        if memory_words is not None:
-            # Note: For some reason, an array created as a "multiple" of c_char
-            # does not have the right type. ctypes.create_string_buffer must be
-            # used.
-            self.M = Memory(create_string_buffer(memory_words * word_bytes))
+        # True if the memory is an anonymous mapping owned by this State, so
+        # that it owns whole pages, and `load()` can map files over it.
+        self._own_mapping = memory is None and memory_words is not None
+        if self._own_mapping:
+            # Allocate the memory with `mmap`, so that it is aligned to a
+            # page, and files can be mapped into it by `load()`.
+            memory = mmap.mmap(-1, memory_words * word_bytes)
+        if memory is not None:
+            memory = memoryview(memory).cast('B')
+            if len(memory) % word_bytes != 0:
+                raise Error("memory is not a whole number of words")
+            self.M = Memory((c_char * len(memory)).from_buffer(memory))
             self.M_word = Memory(self.M.buffer, element_size=word_bytes)
             self.pc = self.M.start
         else:
             self.pc = None
+        self.context = c_context()
+        # A pointer to `context.stack_depth`, to pass to `run()`.
+        self._stack_depth_ptr = pointer(c_uword.from_buffer(
+            self.context, c_context.stack_depth.offset
+        ))
+        self.run_fn = run_fn
+        self.stack_words = stack_words
+        self.break_fn = None
+        self._stack = None
+        self._trace_buffer = None
+        self._watch_hits = None
+        self._dirty_tracker = None
+        self._baseline = None
+        self._verified = None
         if args is not None:
             assert isinstance(args, list)
             args.insert(0, b"python")
             register_args(*args)
 
-    def run(self, run_fn=run_simple):
+    def _ensure_stack(self):
+        '''
+        (Re)allocate the stack if `stack_words` has changed, keeping as much
+        of its contents as will fit.
+        '''
+        words = self.stack_words
+        if words is None:
+            words = thread_locals.stack_words.value
+        if self._stack is None or len(self._stack) != words:
+            old_stack = self._stack
+            self._stack = (c_word * words)()
+            self.context.stack = self._stack
+            self.context.stack_words = words
+            if old_stack is not None:
+                depth = min(self.context.stack_depth, len(self._stack))
+                self._stack[:depth] = old_stack[:depth]
+                self.context.stack_depth = depth
+
+    @property
+    def stack(self):
+        '''
+        A memoryview of the items on the stack, bottom first. It shares
+        memory with the stack, so it is only valid until the stack is next
+        reallocated, which happens when `stack_words` changes.
+        '''
+        self._ensure_stack()
+        # `c_word` is `ssize_t`, whose struct format is 'n'.
+        stack = memoryview(self._stack).cast('B').cast('n')
+        return stack[:self.context.stack_depth]
+
+    @property
+    def break_fn(self):
+        return self._break_fn
+
+    @break_fn.setter
+    def break_fn(self, break_fn):
+        self._break_fn = break_fn
+        # Keep the callback alive while it is in use.
+        self._c_break_fn = c_mit_fn(break_fn) if break_fn is not None else None
+
+    def run(self, run_fn=None, keep_stack=False):
         '''
         Run until execution halts. Execution will start at `self.pc` with an
-        empty stack of capacity `stack_words`.
-
-         - run_fn - optional c_mit_fn - c_mit_fn to use. Defaults to
-           `run_simple`.
-        '''
-        run_ptr.contents = run_fn
-        run(
-            cast(self.pc, POINTER(c_word)),
-            0, # ir
-            cast((c_word * stack_words.value)(), POINTER(c_word)),
-            stack_words.value,
-            byref(c_uword(0)),
-        )
+        empty stack of capacity `stack_words`. The stack is left as it was
+        when execution halted, and can be read from `stack`.
+
+         - run_fn - optional c_mit_fn or str - c_mit_fn to use, or its name
+           in `binding.run_fns`, such as 'fast' or 'profile'. Defaults to
+           `self.run_fn`.
+         - keep_stack - optional bool - if true, start with the stack left
+           by the previous run, rather than an empty stack.
+        '''
+        if run_fn is None:
+            run_fn = self.run_fn
+        if isinstance(run_fn, str):
+            try:
+                run_fn = run_fns[run_fn]
+            except KeyError:
+                raise Error(f"no such run function '{run_fn}' in this libmit")
+        self._ensure_stack()
+        context = self.context
+        context.pc = cast(self.pc, POINTER(c_word))
+        context.ir = 0
+        if not keep_stack:
+            context.stack_depth = 0
+        with _run_lock:
+            variables = thread_locals
+            old_run_fn = variables.run_ptr.contents
+            old_stack_words = variables.stack_words.value
+            old_break_fn = variables.break_fn_ptr.value
+            old_verified = (
+                variables.verified_pc.value,
+                variables.verified_length.value,
+                variables.verified_table.value,
+            )
+            variables.run_ptr.contents = run_fn
+            variables.stack_words.value = context.stack_words
+            if self._c_break_fn is not None:
+                # We need the actual C function entry point, not the address of
+                # the Python object, which is what we would get from a
+                # `CFunctionType`.
+                variables.break_fn_ptr.value = cast(self._c_break_fn, c_void_p).value
+            # The verified table is only used while this State is running, so
+            # it cannot be used after it is freed, or by another State.
+            if self._verified is not None:
+                addr, length, table = self._verified
+                variables.verified_pc.value = addr
+                variables.verified_length.value = length
+                variables.verified_table.value = addressof(table)
+            else:
+                variables.verified_length.value = 0
+            try:
+                with running():
+                    run(
+                        context.pc,
+                        context.ir,
+                        context.stack,
+                        context.stack_words,
+                        self._stack_depth_ptr,
+                    )
+            finally:
+                variables.run_ptr.contents = old_run_fn
+                variables.stack_words.value = old_stack_words
+                variables.break_fn_ptr.value = old_break_fn
+                (
+                    variables.verified_pc.value,
+                    variables.verified_length.value,
+                    variables.verified_table.value,
+                ) = old_verified
+
+    async def run_async(self, timeout=None, keep_stack=False, executor=None):
+        '''
+        Like `run()`, but a coroutine, which runs the VM with `run_fuel` in
+        a worker thread of `executor` (by default, the event loop's default
+        executor), so that the event loop can run other tasks meanwhile.
+        `run_fuel` is always used, as it is the only engine that can be
+        interrupted, so `run_fn` and `break_fn` are ignored. It runs code as
+        `run_simple` does, without stack caching.
+
+        If the task is cancelled, or `timeout` seconds pass, the run is
+        stopped by setting `context.interrupt`, which `run_fuel` tests
+        before running each word of code. `self.pc` is then set to the
+        address of the next word, and `asyncio.CancelledError` or
+        `asyncio.TimeoutError` is raised. If the run stopped inside a call,
+        the stack of the outermost frame is not up to date.
+
+         - timeout - optional float - the number of seconds after which to
+           stop.
+         - keep_stack - optional bool - as for `run()`.
+         - executor - optional concurrent.futures.Executor - the executor to
+           run the VM in.
+        '''
+        # asyncio is slow to import, so only import it when it is used.
+        import asyncio
+        self._ensure_stack()
+        context = self.context
+        context.pc = cast(self.pc, POINTER(c_word))
+        context.ir = 0
+        if not keep_stack:
+            context.stack_depth = 0
+        context.interrupt = 0
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(executor, self._run_fuel)
+        try:
+            error = await asyncio.wait_for(asyncio.shield(future), timeout)
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            self.interrupt()
+            await asyncio.shield(future)
+            self.pc = cast(context.pc, c_void_p).value
+            raise
+        mit_error(error)
+
+    def _run_fuel(self):
+        '''
+        Run `context` with `run_fuel` until it halts or is interrupted, and
+        return the error code. The call frames of an interrupted run are
+        discarded on the thread that made them.
+        '''
+        with running():
+            error = run_fuel(byref(self.context), byref(c_uword(uword_max)))
+        if error == enums.MitErrorCode.INTERRUPTED:
+            context_reset(self.context)
+        return error
+
+    def interrupt(self):
+        '''
+        Stop a run started by `run_async()`, from any thread.
+        '''
+        self.context.interrupt = 1
 
-    def step(self, n=1, addr=None, trace=False, step_callback=None, final_callback=None):
+    def step(self, n=1, addr=None, trace=False, step_callback=None, final_callback=None, keep_stack=False):
         '''
         Single-step for `n` steps, or until `pc`=addr. See class BreakHandler
-        for details. Initial conditions are as for `run()`.
+        for details. Initial conditions are as for `run()`, and `keep_stack`
+        is passed to it.
         '''
         with BreakHandler(self, n, addr, trace, step_callback, final_callback) as handler:
             try:
-                self.run(run_fn=run_break)
+                self.run(run_fn=run_break, keep_stack=keep_stack)
             except VMError as e:
                 if e.args[0] == enums.MitErrorCode.BREAK:
                     return
                 ret = e.args[0]
+                if handler.native:
+                    # `break_fn` was not called before the error.
+                    handler.done = handler._steps - thread_locals.break_steps.value
+                    self.pc = thread_locals.break_error_pc.value
                 steps = "{} step{}".format(
                     handler.done,
                     's' if handler.done != 1 else ''
@@ -93,38 +319,220 @@ class State:
                 print(f"Error code {ret} was returned after {steps} at pc={self.pc:#x}")
                 raise
 
+    def start_trace(self, length=65536):
+        '''
+        Start recording a trace of the instructions executed by `run_trace`
+        on the current thread, in a ring buffer that holds the most recent
+        `length` instructions. `length` is rounded up to a power of two.
+        '''
+        length = 1 << max(length - 1, 0).bit_length()
+        self._trace_buffer = (c_trace_entry * length)()
+        thread_locals.trace_buffer.value = addressof(self._trace_buffer)
+        thread_locals.trace_length.value = length
+        thread_locals.trace_count.value = 0
+
+    def stop_trace(self):
+        '''
+        Stop recording a trace. The trace recorded so far is kept.
+        '''
+        thread_locals.trace_length.value = 0
+
+    def trace_records(self):
+        '''
+        Return the trace recorded since `start_trace()`, oldest entry first,
+        as an array of `c_trace_entry`. The array supports the buffer
+        protocol, so it can be viewed with `memoryview()` or
+        `numpy.ctypeslib.as_array()` without copying. The array shares
+        memory with the ring buffer unless the buffer has wrapped around.
+        '''
+        buffer = self._trace_buffer
+        if buffer is None:
+            return (c_trace_entry * 0)()
+        length = len(buffer)
+        count = thread_locals.trace_count.value
+        if count <= length:
+            return (c_trace_entry * count).from_buffer(buffer)
+        start = count % length
+        entry_bytes = sizeof(c_trace_entry)
+        records = (c_trace_entry * length)()
+        memmove(
+            records,
+            addressof(buffer) + start * entry_bytes,
+            (length - start) * entry_bytes,
+        )
+        memmove(
+            addressof(records) + (length - start) * entry_bytes,
+            buffer,
+            start * entry_bytes,
+        )
+        return records
+
+    def watch(self, addrs, max_hits=1024):
+        '''
+        Watch writes by `run_watch` on the current thread to the words at
+        `addrs`, recording at most `max_hits` hits. Replaces any addresses
+        previously watched, and clears the hits recorded.
+
+        Writes are caught by protecting the pages that contain `addrs`, so
+        each page must belong wholly to `M`.
+        '''
+        addrs = list(addrs)
+        for addr in addrs:
+            if not is_aligned(addr):
+                raise Error(f"watched address {addr:#x} is not aligned")
+            if not self._owns_page(addr):
+                raise Error(f"watched address {addr:#x} is not in a page of M")
+        self._watch_addrs = (c_void_p * len(addrs))(*addrs)
+        self._watch_hits = (c_watch_hit * max_hits)()
+        thread_locals.watch_addrs.value = addressof(self._watch_addrs)
+        thread_locals.watch_length.value = len(addrs)
+        thread_locals.watch_hits.value = addressof(self._watch_hits)
+        thread_locals.watch_hits_length.value = max_hits
+        thread_locals.watch_hits_count.value = 0
+
+    def _owns_page(self, addr):
+        '''
+        Test whether the page containing `addr` belongs wholly to `M`, so
+        that protecting it cannot affect anything else.
+        '''
+        if not hasattr(self, 'M'):
+            return False
+        page = addr & ~(mmap.PAGESIZE - 1)
+        end = self.M.end
+        if self._own_mapping:
+            # The mapping is a whole number of pages.
+            end = (end + mmap.PAGESIZE - 1) & ~(mmap.PAGESIZE - 1)
+        return self.M.start <= page and page + mmap.PAGESIZE <= end
+
+    def unwatch(self):
+        '''
+        Stop watching writes. The hits recorded so far are kept.
+        '''
+        thread_locals.watch_length.value = 0
+
+    def watch_hits(self):
+        '''
+        Return the hits recorded since `watch()`, as an array of
+        `c_watch_hit`, and the total number of hits, which may be larger
+        than the length of the array.
+        '''
+        count = thread_locals.watch_hits_count.value
+        if self._watch_hits is None:
+            return (c_watch_hit * 0)(), count
+        recorded = min(count, len(self._watch_hits))
+        return (c_watch_hit * recorded).from_buffer(self._watch_hits), count
+
+    def snapshot(self):
+        '''
+        Return a Snapshot of the memory `M`, the stack and `pc`, which can
+        be restored with `restore()`.
+
+        Writes to `M` are tracked from the most recent snapshot or restore,
+        so that restoring that snapshot only needs to copy the pages that
+        have been written. Where dirty pages cannot be tracked, every page
+        is compared with the snapshot, and only those that differ are
+        copied, as they are when a snapshot or restore of another State may
+        have missed writes by a State running in another thread (see
+        DirtyTracker).
+        '''
+        snapshot = Snapshot(self)
+        self._track_writes(snapshot)
+        return snapshot
+
+    def _track_writes(self, snapshot):
+        '''
+        Track writes to `M` from now on, relative to `snapshot`.
+        '''
+        if self._dirty_tracker is None:
+            self._dirty_tracker = DirtyTracker(self.M.start, self.M.end)
+        self._dirty_tracker.clear()
+        self._baseline = snapshot
+
+    def restore(self, snapshot):
+        '''
+        Restore a Snapshot made by `snapshot()` of this State or of another
+        with the same size of memory.
+
+        Returns the number of pages of memory copied.
+        '''
+        if len(snapshot.memory) != len(self.M):
+            raise Error("snapshot has a different size of memory")
+        dirty = None
+        if snapshot is self._baseline:
+            dirty = self._dirty_tracker.dirty_bitmap()
+        copied = restore_pages(
+            self.M.start,
+            addressof(snapshot.memory),
+            len(self.M),
+            mmap.PAGESIZE,
+            dirty,
+        )
+        self._track_writes(snapshot)
+        self._ensure_stack()
+        depth = min(len(snapshot.stack), len(self._stack))
+        self._stack[:depth] = snapshot.stack[:depth]
+        self.context.stack_depth = depth
+        pc = snapshot.pc
+        if pc is not None and snapshot.start <= pc < snapshot.start + len(snapshot.memory):
+            # Move `pc` to the same place in this State's memory.
+            pc += self.M.start - snapshot.start
+        self.pc = pc
+        return copied
+
+    def verify(self, addr, length):
+        '''
+        Verify `length` words of code from `addr`, so that `run_verified`
+        can run them with fewer checks when this State is run. Replaces any
+        code previously verified.
+
+        Returns the table of `c_verified_word` made by `verifier.verify()`.
+        '''
+        table = verify(self, addr, length)
+        self._verified = (addr, length, table)
+        return table
+
     def load(self, filename, addr=None):
         '''
         Load a binary file at the given address, which must be in `M`.
         `addr` defaults to `M.start`. The length of the file must be a whole
         number of words, not including any "#!" line.
 
+        If the State allocated its memory, the file is mapped into it
+        copy-on-write where possible (see `mit_load_file()`), so that pages
+        are only read when touched. The file should then not be truncated
+        or overwritten while the memory is in use: the memory may change,
+        even where it has been written, and reading a page beyond the new
+        end of the file raises SIGBUS. `save()` replaces files rather than
+        overwriting them, so it is safe to use on a loaded file. Memory given to
+        `__init__()` is written instead, so that other users of it, such as
+        other mappings of a shared memory segment, see the file.
+
         Returns the length of the file in words.
         '''
-        def strip_hashbang(data):
-            if data[:2] != b'#!':
-                return data
-            try:
-                return data[data.index(b'\n') + 1:]
-            except ValueError: # No \n, so just a #! line
-                return b''
-
         with open(filename, 'rb') as h:
-            data = h.read()
-        data = strip_hashbang(data)
-        if len(data) % word_bytes != 0:
-            raise Error(f"file '{filename}' is not a whole number of words")
-        assert self.M is not None
-        if addr is None:
-            addr = self.M.start
-        end_addr = addr + len(data)
-        if end_addr > self.M.end:
-            raise Error(f"file '{filename}' does not fit in memory at {addr:#x}")
-        try:
-            self.M[addr:end_addr] = data
-        except IndexError:
-            raise Error("invalid or unaligned address")
-        return len(data) // word_bytes
+            # Skip any #! line.
+            if h.read(2) == b'#!':
+                h.readline()
+            else:
+                h.seek(0)
+            offset = h.tell()
+            length = os.fstat(h.fileno()).st_size - offset
+            if length % word_bytes != 0:
+                raise Error(f"file '{filename}' is not a whole number of words")
+            assert self.M is not None
+            if addr is None:
+                addr = self.M.start
+            if not is_aligned(addr) or not self.M.start <= addr < self.M.end:
+                raise Error("invalid or unaligned address")
+            if addr + length > self.M.end:
+                raise Error(f"file '{filename}' does not fit in memory at {addr:#x}")
+            if self._own_mapping:
+                load_file(h.fileno(), offset, length, addr)
+            else:
+                index = addr - self.M.start
+                if h.readinto(self.M.view[index:index + length]) != length:
+                    raise Error(f"error reading file '{filename}'")
+        return length // word_bytes
 
     def save(self, filename, addr=None, length=None):
         '''
@@ -133,6 +541,12 @@ class State:
          - addr - int - start address, defaults to `self.M.start`.
          - length - int - length in words, defaults to saving up to the end of
            `self.M`.
+
+        An existing file is replaced rather than overwritten, as it may be
+        mapped by `load()`: the data is written to a temporary file in the
+        same directory, which is then renamed over the file (or, if it is a
+        symbolic link, over its target), keeping its permissions. Other hard
+        links to the file still refer to the old contents.
         '''
         if addr is None:
             addr = self.M.start
@@ -144,8 +558,20 @@ class State:
             data = bytes(self.M[addr:end_addr])
         except IndexError:
             raise Error("invalid or unaligned address")
-        with open(filename, 'wb') as h:
-            h.write(data)
+        filename = os.path.realpath(filename)
+        if not os.path.exists(filename):
+            with open(filename, 'wb') as h:
+                h.write(data)
+            return
+        fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename))
+        try:
+            with open(fd, 'wb') as h:
+                h.write(data)
+            shutil.copymode(filename, tmp_filename)
+            os.replace(tmp_filename, filename)
+        except:
+            os.remove(tmp_filename)
+            raise
 
     def disassemble(self, start=None, length=None, end=None, file=sys.stdout):
         '''
@@ -169,28 +595,25 @@ class State:
             end = min(start + 64 * word_bytes, self.M.end)
         assert self.M.start <= start <= end <= self.M.end
 
+        data = self.M.read_bytes(start, end - start)
         chunk = 16
+        lines = []
         p = start - start % chunk
         while p < end:
-            print(("{:#0" + str(hex0x_word_width) + "x} ").format(p), end='', file=file)
-            ascii = ""
-            i = 0
-            while i < chunk and p < end:
-                if i % 8 == 0:
-                    print(" ", end='', file=file)
-                if start <= p + i < end:
-                    byte = self.M[p + i]
-                    byte_hex = f"{byte:02x}"
-                    c = chr(byte)
-                    c = c if c.isprintable() else '.'
-                else:
-                    byte_hex = "  "
-                    c = " "
-                print(f"{byte_hex} ", end='', file=file)
-                ascii += c
-                i += 1
+            pad = max(start - p, 0)
+            row = data[max(p - start, 0):p + chunk - start]
+            byte_hex = ["  "] * pad + [f"{byte:02x}" for byte in row]
+            byte_hex += ["  "] * (chunk - len(byte_hex))
+            ascii = " " * pad + "".join(
+                chr(byte) if chr(byte).isprintable() else '.' for byte in row
+            )
+            lines.append("{:#0{}x}  {}  {}  |{:{}}|\n".format(
+                p, hex0x_word_width,
+                " ".join(byte_hex[:chunk // 2]), " ".join(byte_hex[chunk // 2:]),
+                ascii, chunk,
+            ))
             p += chunk
-            print(f" |{ascii:.{chunk}}|", file=file)
+        file.write("".join(lines))
 
     def dump_files(self, basename, addr, length):
         '''
@@ -212,7 +635,8 @@ class BreakHandler:
      - state - State - state to use.
      - n - int or None - number of instructions (including `next` and
        `nextff`) to run.
-     - addr - int or None - address to run to.
+     - addr - int, iterable of int, or None - address or addresses to run
+       to.
      - trace - bool - if true, print tracing information for each
        instruction.
      - step_callback - optional function - if not None, a function
@@ -224,6 +648,13 @@ class BreakHandler:
      - done - int - number of instructions run so far.
 
     If both `addr` and `n` are set, `addr` takes priority.
+
+    Unless `trace` is true or `step_callback` is set, the exit condition is
+    tested natively by `mit_run_break`, using `mit_break_steps` and
+    `mit_breakpoints`, and `break_fn` is only called when it is reached.
+
+    While the handler is entered, `break_fn` is the `break_fn` of `state`,
+    and the handler must be used on the thread that runs `state`.
     '''
     state: State
     n: int = 1
@@ -238,24 +669,53 @@ class BreakHandler:
 
     def __post_init__(self):
         self.done = 0
+        if isinstance(self.addr, int):
+            self.addrs = {self.addr}
+        elif self.addr is not None:
+            self.addrs = set(self.addr)
+        else:
+            self.addrs = None
+        self.native = not self.trace and self.step_callback is None
 
     def log(self, *args, **kwargs):
         print(*args, file=sys.stderr, **kwargs)
         sys.stderr.flush()
 
     def __enter__(self):
-        self._old_break_fn = break_fn_ptr.value if break_fn_ptr else None
-        # Prevent c_break_fn being GC'ed.
-        self._new_break_fn = c_mit_fn(self.break_fn)
-        # We need the actual C function entry point, not the address of the
-        # Python object, which is what we would get from a `CFunctionType`.
-        break_fn_ptr.value = cast(self._new_break_fn, c_void_p).value
+        self._old_break_fn = self.state.break_fn
+        self.state.break_fn = self.break_fn
+        if self.native:
+            self._set_breakpoints()
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        if self._old_break_fn is not None:
-            break_fn_ptr.value = self._old_break_fn
-        self._new_break_fn = None
+        self.state.break_fn = self._old_break_fn
+        thread_locals.break_steps.value = 0
+        thread_locals.breakpoints_length.value = 0
+        self._breakpoints = None
+
+    def _set_breakpoints(self):
+        '''
+        Set `mit_break_steps` and `mit_breakpoints` to the exit condition.
+        '''
+        if self.addrs is None:
+            self._steps = self.n
+            thread_locals.break_steps.value = self._steps
+            return
+        self._steps = uword_max
+        thread_locals.break_steps.value = self._steps
+        addrs = [addr for addr in self.addrs if is_aligned(addr)]
+        if len(addrs) == 0:
+            return
+        start = min(addrs)
+        length = (max(addrs) - start) // word_bytes + 1
+        self._breakpoints = (c_ubyte * ((length + 7) // 8))()
+        for addr in addrs:
+            index = (addr - start) // word_bytes
+            self._breakpoints[index // 8] |= 1 << (index % 8)
+        thread_locals.breakpoints_pc.value = start
+        thread_locals.breakpoints.value = addressof(self._breakpoints)
+        thread_locals.breakpoints_length.value = length
 
     def break_fn(self, pc, ir, stack, stack_words, stack_depth):
         '''
@@ -270,8 +730,10 @@ class BreakHandler:
         else:
             stack = []
 
-        if self.addr is not None:
-            terminate = self.state.pc == self.addr
+        if self.native:
+            self.done = self._steps - thread_locals.break_steps.value
+        if self.addrs is not None:
+            terminate = self.state.pc in self.addrs
         else:
             terminate = self.done >= self.n
         if terminate:
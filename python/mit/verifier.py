@@ -0,0 +1,169 @@
+'''
+Verify code for `mit_run_verified()`.
+
+(c) Mit authors 2020
+
+The package is distributed under the MIT/X11 License.
+
+THIS PROGRAM IS PROVIDED AS IS, WITH NO WARRANTY. USE IS AT THE USER’S
+RISK.
+'''
+
+from .binding import c_verified_word, sign_extend, uword_max, word_bytes
+from .enums import ExtraInstructions, Instructions, spec
+from .enums import Instructions as I
+
+
+# The alignment in bytes required of the `addr` argument of each
+# instruction that checks it.
+ALIGNMENT = {
+    I.LOAD: word_bytes,
+    I.STORE: word_bytes,
+    I.LOAD2: 2,
+    I.STORE2: 2,
+    I.LOAD4: 4,
+    I.STORE4: 4,
+    I.JUMP: word_bytes,
+    I.JUMPZ: word_bytes,
+}
+
+
+class Unverifiable(Exception):
+    '''
+    Raised by `verify_word()` when a word of code cannot be verified.
+    '''
+    pass
+
+
+def _expand(names, count):
+    names = list(names)
+    if 'ITEMS' in names:
+        i = names.index('ITEMS')
+        names[i:i + 1] = [('ITEMS', j) for j in range(count)]
+    return names
+
+
+def verify_word(state, addr):
+    '''
+    Verify the word of code at `addr` in `state.M_word`, by simulating its
+    instructions from an unknown stack.
+
+    The stack items that the word needs, and the stack space that it uses,
+    are computed from the stack effects in `enums.spec`. The values of items
+    pushed by `pushi` and `pushreli` are tracked through the stack, so that
+    constant addresses can be proved to be aligned. Values read from literal
+    words by `push` and `pushrel` are not tracked, as they could be changed
+    without changing the word itself.
+
+    Returns `(pops, pushes)`: the stack depth and free space needed to run
+    the word without stack checks. Raises `Unverifiable` if the word cannot
+    be verified.
+    '''
+    ir = sign_extend(state.M_word[addr])
+    pc = addr + word_bytes
+    stack = {} # Known values, by position relative to the initial depth.
+    depth = 0
+    pops = pushes = 0
+
+    def run_effect(effect, opcode):
+        nonlocal depth, pops, pushes
+        args, results = effect['args'], effect['results']
+        count = 0
+        if 'COUNT' in args:
+            count = stack.get(depth - 1)
+            if count is None or not 0 <= count < 0x10000:
+                raise Unverifiable(f'unknown COUNT at {addr:#x}')
+            args, results = _expand(args, count), _expand(results, count)
+        base = depth - len(args)
+        values = {name: stack.get(base + i) for i, name in enumerate(args)}
+        alignment = ALIGNMENT.get(opcode)
+        if alignment is not None and 'addr' in values:
+            if values['addr'] is None or values['addr'] % alignment != 0:
+                raise Unverifiable(f'unknown alignment at {addr:#x}')
+        for i in range(len(args)):
+            stack.pop(base + i, None)
+        pops = max(pops, -base)
+        for i, name in enumerate(results):
+            if values.get(name) is not None:
+                stack[base + i] = values[name]
+        depth = base + len(results)
+        pushes = max(pushes, depth)
+
+    def push(value):
+        run_effect({'args': [], 'results': ['x']}, None)
+        if value is not None:
+            stack[depth - 1] = value & uword_max
+
+    while True:
+        opcode = ir & 0xff
+        ir >>= 8
+        try:
+            instruction = Instructions(opcode)
+        except ValueError:
+            # Invalid opcodes throw an error without touching the stack.
+            break
+        description = spec['Instructions'][instruction.name]
+        terminal = (
+            description.get('terminal') is not None and
+            ir != (0 if opcode & 0x80 == 0 else -1)
+        )
+        if terminal:
+            if instruction == I.NEXT:
+                # Extra instructions check the stack themselves, but not the
+                # alignment of the address given to `catch`.
+                if ir == ExtraInstructions.CATCH:
+                    target = stack.get(depth - 1)
+                    if target is None or target % word_bytes != 0:
+                        raise Unverifiable(f'unknown alignment at {addr:#x}')
+                break
+            elif instruction in (I.JUMP, I.JUMPZ):
+                run_effect(description['terminal'], None)
+                if instruction == I.JUMP:
+                    break
+                # If the jump is not taken, execution continues with `ir`.
+            elif instruction == I.CALL:
+                break
+            else:
+                # A trap may change the stack arbitrarily.
+                raise Unverifiable(f'trap at {addr:#x}')
+        elif instruction in (I.NEXT, I.NEXTFF, I.RET):
+            break
+        elif instruction == I.CALL:
+            target = stack.get(depth - 1)
+            if target is None or target % word_bytes != 0:
+                raise Unverifiable(f'unknown alignment at {addr:#x}')
+            break
+        elif instruction in (I.PUSH, I.PUSHREL):
+            push(None)
+            pc += word_bytes
+        elif opcode & 0x3 in (0x1, 0x2): # PUSHRELI_N
+            n = (opcode - I.PUSHRELI_0) >> 2
+            if opcode & 0x3 == 0x2: # negative
+                n |= ~0x3f
+            push(pc + n * word_bytes)
+        elif opcode & 0x7 in (0x3, 0x4): # PUSHI_N
+            n = (opcode - I.PUSHI_0) >> 3
+            if opcode & 0x7 == 0x4: # negative
+                n |= ~0x1f
+            push(n)
+        else:
+            run_effect(description['action'], opcode)
+    return pops, pushes
+
+
+def verify(state, addr, length):
+    '''
+    Verify `length` words of code starting at `addr` in `state.M_word`.
+
+    Returns an array of `c_verified_word` suitable for use as
+    `mit_verified_table`.
+    '''
+    table = (c_verified_word * length)()
+    for i in range(length):
+        word_addr = addr + i * word_bytes
+        table[i].ir = sign_extend(state.M_word[word_addr])
+        try:
+            table[i].pops, table[i].pushes = verify_word(state, word_addr)
+        except Unverifiable:
+            table[i].pops, table[i].pushes = uword_max, 0
+    return table
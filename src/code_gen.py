@@ -7,8 +7,11 @@
 # THIS PROGRAM IS PROVIDED AS IS, WITH NO WARRANTY. USE IS AT THE USER’S
 # RISK.
 
+from dataclasses import dataclass
+
 from code_util import Code, unrestrict, disable_warnings, c_symbol
 from stack import StackEffect, Size, type_words
+from action import ActionEnum
 
 
 def load_stack(name, depth=0, type='mit_word_t'):
@@ -170,11 +173,14 @@ def store_results(stack_effect):
             code.extend(store_item(item))
     return code
 
-def gen_action_code(action):
+def gen_action_code(action, check=True):
     '''
     Generate a Code for an Action.
 
-    This is suitable for passing as the `gen_code` argument of `dispatch()`.
+    This is suitable for passing as the `gen_code` argument of
+    `dispatch_table()`.
+     - check - bool - if `False`, the caller has already checked that the
+       stack has enough items and space for `action`.
     '''
     effect = action.effect
     code = Code()
@@ -189,8 +195,9 @@ def gen_action_code(action):
             # check_underflow call, so the compiler can elide one check.
             code.extend(check_underflow(Size(effect.args.size.size)))
             code.extend(load_item(count))
-        code.extend(check_underflow(effect.args.size))
-        code.extend(check_overflow(effect.args.size, effect.results.size))
+        if check:
+            code.extend(check_underflow(effect.args.size))
+            code.extend(check_overflow(effect.args.size, effect.results.size))
         code.extend(load_args(effect))
     code.extend(action.code)
     if effect is not None:
@@ -199,64 +206,194 @@ def gen_action_code(action):
         code.extend(store_results(effect))
     return code
 
-def gen_instruction_code(instruction):
+def gen_instruction_code(instruction, check=True):
     '''
     Generate a Code for an Instruction.
 
-    This is suitable for passing as the `gen_code` argument of `dispatch()`.
+    This is suitable for passing as the `gen_code` argument of
+    `dispatch_table()`.
+     - check - bool - as for `gen_action_code()`.
     '''
-    code = gen_action_code(instruction.action)
+    code = gen_action_code(instruction.action, check)
     if instruction.terminal is not None:
         ir_all_bits = 0 if instruction.opcode & 0x80 == 0 else -1
         code = Code(
             f'if (ir != {ir_all_bits}) {{',
-            gen_action_code(instruction.terminal),
+            gen_action_code(instruction.terminal, check),
             '} else {',
             code,
             '}',
         )
     return code
 
-def dispatch(actions, undefined_case, opcode='opcode', gen_code=gen_action_code):
+def dispatch_table(
+        actions,
+        undefined_case,
+        opcode='opcode',
+        gen_code=gen_action_code,
+        table='dispatch',
+        size=None,
+        bounded=True,
+):
     '''
-    Generate dispatch code for an ActionEnum.
+    Generate table dispatch code for an ActionEnum, so that each action
+    costs one indirect jump. If the C compiler supports computed goto, a
+    table of label addresses is generated; otherwise, a dense `switch`. The
+    macros used are defined in run.h.
      - actions - ActionEnum.
      - undefined_case - Code - the fallback behaviour.
      - opcode - str - a C expression for the opcode.
      - gen_code - function - a function that takes an ActionEnum instance and
        returns C code to implement it. In the code, errors are reported by
        calling THROW().
+     - table - str - a C identifier for the table, which is also used to
+       construct label names, so must be unique within the function.
+     - size - int - the number of table entries; opcodes must be less than
+       `size`. Defaults to one more than the largest opcode.
+     - bounded - bool - if `False`, `opcode` is known to be less than
+       `size`, so the bounds check is omitted.
     '''
     assert isinstance(undefined_case, Code), undefined_case
-    code = Code()
-    else_text = ''
-    for (_, value) in enumerate(actions):
-        opcode_symbol = f'{c_symbol(actions.__name__)}_{value.name}'
-        code.append(
-            f'{else_text}if ({opcode} == {opcode_symbol}) {{'
-        )
+    if size is None:
+        size = max(value.opcode for value in actions) + 1
+    opcode_symbols = {
+        value.opcode: f'{c_symbol(actions.__name__)}_{value.name}'
+        for value in actions
+    }
+    assert max(opcode_symbols) < size
+    labels = [
+        f'&&{table}_{opcode_symbols[i]},' if i in opcode_symbols
+        else f'&&{table}_default,'
+        for i in range(size + 1)
+    ]
+    # Declare the labels local to the block, so that the same dispatch code
+    # can be generated more than once in a function.
+    local_labels = [f'{table}_{symbol}' for symbol in opcode_symbols.values()]
+    local_labels.extend([f'{table}_default', f'{table}_end'])
+    code = Code(
+        '#ifdef HAVE_COMPUTED_GOTO',
+        '__label__',
+        Code(',\n'.join(local_labels) + ';'),
+        f'static void * const {table}[{size + 1}] = {{',
+        Code(*labels),
+        '};',
+        '#endif',
+    )
+    dispatch_macro = 'DISPATCH_TABLE_BOUNDED' if bounded else 'DISPATCH_TABLE'
+    code.append(f'{dispatch_macro}({table}, {opcode}, {size}) {{')
+    for value in actions:
+        code.append(f'DISPATCH_CASE({table}, {opcode_symbols[value.opcode]}): {{')
         code.append(gen_code(value.action))
         code.append('}')
-        else_text = 'else '
-    code.append(f'{else_text}{{')
+        code.append(Code(f'DISPATCH_BREAK({table});'))
+    code.append(f'DISPATCH_DEFAULT({table}): {{')
     code.append(undefined_case)
     code.append('}')
-    return code
+    code.append('}')
+    code.append(f'DISPATCH_END({table})')
+    # Computed goto and local labels are GNU extensions.
+    return disable_warnings(['-Wpedantic'], Code('{', code, '}'))
 
-def run_body(instructions):
+def gen_guarded_instruction_code(instruction):
+    '''
+    Generate a Code for an Instruction, for use with guard pages: the stack
+    is not checked, except for variadic instructions, whose stack accesses
+    could skip a guard page.
+    '''
+    effect = instruction.action.effect
+    return gen_instruction_code(
+        instruction,
+        check=effect is not None and effect.args.size.count != 0,
+    )
+
+def run_body(instructions, gen_code=gen_instruction_code):
     '''
     Compute the instruction dispatch code for an inner run function.
+
+     - gen_code - function - as for `dispatch_table()`.
     '''
-    return dispatch(
+    return dispatch_table(
         instructions,
         Code(
             '// Undefined instruction.',
             'THROW(MIT_ERROR_INVALID_OPCODE);'
         ),
-        gen_code=gen_instruction_code,
+        gen_code=gen_code,
+        size=1 << 8,
+        bounded=False,
+    )
+
+def inner_fn(suffix, body, error_code=Code(), resume=None):
+    '''
+    Generate a `run_inner` function.
+
+     - suffix - str - the function is named `run_inner_{suffix}`.
+     - body - Code - the body of the function, which must start by checking
+       `stack_depth`.
+     - error_code - Code - code to run on error, before unwinding.
+     - resume - str - if given, `call`, `ret` and `catch` do not recurse, but
+       use `DO_CALL_FLAT`, `DO_RET_FLAT` and `DO_CATCH_FLAT`, and `resume`
+       is a statement that resumes execution after an error is caught.
+       The function returns an error code rather than calling `longjmp()`.
+       Otherwise, `DO_CALL_RECURSIVE`, `DO_RET_RECURSIVE` and
+       `DO_CATCH_RECURSIVE` are used.
+    '''
+    code = Code()
+    error_code = Code(*error_code.buffer)
+    if resume is not None:
+        header = f'''\
+            // Define run_outer for the benefit of `catch`.
+            #define run_outer mit_run_{suffix}
+            #define DO_CALL DO_CALL_FLAT
+            #define DO_RET DO_RET_FLAT
+            #define DO_CATCH DO_CATCH_FLAT
+            static mit_word_t run_inner_{suffix}(mit_word_t *pc, mit_word_t ir, mit_word_t *stack, mit_uword_t stack_words, mit_uword_t * restrict stack_depth_ptr)
+            {{'''
+        code.append('''\
+            mit_uword_t stack_depth = *stack_depth_ptr;
+            mit_word_t error;
+
+            // The return stack.
+            struct call_frame *ret_stack = NULL;
+            mit_uword_t ret_depth = 0, ret_words = 0;''')
+        error_code.append(f'CATCH_FLAT_ERROR({resume});')
+        trailer = '''\
+            }
+            #undef run_outer'''
+    else:
+        header = f'''\
+            // Define run_inner for the benefit of `call`.
+            #define run_inner run_inner_{suffix}
+            #define DO_CALL DO_CALL_RECURSIVE
+            #define DO_RET DO_RET_RECURSIVE
+            #define DO_CATCH DO_CATCH_RECURSIVE
+            static void run_inner_{suffix}(mit_word_t *pc, mit_word_t ir, mit_word_t * restrict stack, mit_uword_t stack_words, mit_uword_t * restrict stack_depth_ptr, jmp_buf *jmp_buf_ptr)
+            {{'''
+        code.append('''\
+            #define stack_depth (*stack_depth_ptr)
+            mit_word_t error;''')
+        error_code.append('''\
+            longjmp(*jmp_buf_ptr, error);
+            #undef stack_depth''')
+        trailer = '''\
+            }
+            #undef run_inner'''
+    code.append('')
+    code.extend(body)
+    return Code(
+        header,
+        code,
+        '',
+        'error:',
+        error_code,
+        trailer,
+        '''\
+        #undef DO_CALL
+        #undef DO_RET
+        #undef DO_CATCH''',
     )
 
-def run_inner_fn(instructions, suffix, instrument):
+def run_inner_fn(instructions, suffix, instrument, gen_code=gen_instruction_code, error_code=Code()):
     '''
     Generate a `run_inner` function.
 
@@ -264,60 +401,872 @@ def run_inner_fn(instructions, suffix, instrument):
      - suffix - str - the function is named `run_inner_{suffix}`.
      - instrument - Code or str - instrumentation to insert at start of main
        loop.
+     - gen_code - function - as for `dispatch_table()`.
+     - error_code - Code - as for `inner_fn()`.
     '''
-    return disable_warnings(
-        ['-Wstack-protector', '-Wvla-larger-than='], # TODO: Stack protection cannot cope with VLAs.
+    return inner_fn(suffix, Code(
+        '''\
+        CHECK_STACK_DEPTH;
+        for (;;) {''',
         Code(
-            f'''\
-            // Define run_inner for the benefit of `call`.
-            #define run_inner run_inner_{suffix}
-            static void run_inner_{suffix}(mit_word_t *pc, mit_word_t ir, mit_word_t * restrict stack, mit_uword_t stack_words, mit_uword_t * restrict stack_depth_ptr, jmp_buf *jmp_buf_ptr)
-            {{''',
-            Code(*[
+            instrument,
+            '''\
+            uint8_t opcode = (uint8_t)ir;
+            ir = ARSHIFT(ir, 8);''',
+            run_body(instructions, gen_code),
+        ),
+        '}',
+    ), error_code)
+
+def run_inner_verified_fn(instructions, suffix):
+    '''
+    Generate a `run_inner` function with two copies of the main loop: one
+    that checks every instruction, and one that elides stack and alignment
+    checks, for words of code that `word_verified()` accepts. `next` tests
+    each word that it loads, and continues in the appropriate loop.
+
+     - instructions - ActionEnum - instruction set.
+     - suffix - str - the function is named `run_inner_{suffix}`.
+    '''
+    def main_loop(label, table, gen_code, next_code):
+        return Code(
+            f'{label}:',
+            '#undef DO_NEXT',
+            f'#define DO_NEXT do {{ {next_code}; }} while (0)',
+            'for (;;) {',
+            Code(
                 '''\
-                #define stack_depth (*stack_depth_ptr)
-                mit_word_t error;
-
-                for (;;) {''',
-                instrument,
-                Code('''\
-                    uint8_t opcode = (uint8_t)ir;
-                    ir = ARSHIFT(ir, 8);
-
-                    // Check stack_depth is valid
-                    if (stack_depth > stack_words)
-                        THROW(MIT_ERROR_STACK_OVERFLOW);'''
+                uint8_t opcode = (uint8_t)ir;
+                ir = ARSHIFT(ir, 8);''',
+                dispatch_table(
+                    instructions,
+                    Code(
+                        '// Undefined instruction.',
+                        'THROW(MIT_ERROR_INVALID_OPCODE);'
+                    ),
+                    gen_code=gen_code,
+                    table=table,
+                    size=1 << 8,
+                    bounded=False,
                 ),
-                run_body(instructions),
+            ),
+            '}',
+        )
+    verified = 'word_verified(pc, ir, stack_depth, stack_words, verified_pc, verified_length, verified_table)'
+    return inner_fn(suffix, Code(
+        '''\
+        // Copy the thread-local variables, which may be slow to access.
+        mit_word_t * const verified_pc = mit_verified_pc;
+        const mit_uword_t verified_length = mit_verified_length;
+        const mit_verified_word_t * const verified_table = mit_verified_table;
+        CHECK_STACK_DEPTH;''',
+        '',
+        '// Run unverified code.',
+        *main_loop(
+            'checked',
+            'dispatch',
+            gen_instruction_code,
+            f'ir = *pc++; if ({verified}) goto verified',
+        ).buffer,
+        '',
+        '// Run verified code.',
+        '#undef ALIGNMENT_VERIFIED',
+        '#define ALIGNMENT_VERIFIED 1',
+        *main_loop(
+            'verified',
+            'verified_dispatch',
+            lambda instruction: gen_instruction_code(instruction, check=False),
+            f'ir = *pc++; if (!{verified}) goto checked',
+        ).buffer,
+        '#undef ALIGNMENT_VERIFIED',
+        '#define ALIGNMENT_VERIFIED 0',
+        '#undef DO_NEXT',
+        '#define DO_NEXT ir = *pc++',
+    ))
+
+def run_inner_fuel_fn(instructions, suffix):
+    '''
+    Generate a `run_inner` function for `mit_run_fuel`. `call`, `ret` and
+    `catch` do not recurse, so that the run can be suspended in a call;
+    `next` counts down the fuel, and suspends the run when it runs out or
+    `ctx->interrupt` is set.
+
+     - instructions - ActionEnum - instruction set.
+     - suffix - str - the function is named `run_inner_{suffix}`.
+    '''
+    return Code(
+        f'''\
+        #define DO_CALL DO_CALL_FLAT
+        #define DO_RET                                  \\
+            do {{                                         \\
+                if (ret_depth == 0)                     \\
+                    *fuel_ptr = fuel;                   \\
+                DO_RET_FLAT;                            \\
+            }} while (0)
+        #define DO_CATCH(addr) DO_ENTER_FLAT(addr, true)
+        #undef DO_NEXT
+        #define DO_NEXT                                         \\
+            do {{                                                 \\
+                if (unlikely(fuel == 0 || ctx->interrupt))      \\
+                    goto suspend;                               \\
+                fuel--;                                         \\
+                ir = *pc++;                                     \\
+            }} while (0)
+        static mit_word_t run_inner_{suffix}(mit_context_t *ctx, mit_uword_t *fuel_ptr)
+        {{''',
+        Code(
+            '''\
+            mit_word_t *pc = ctx->pc;
+            mit_word_t ir = ctx->ir;
+            mit_word_t *stack = ctx->stack;
+            mit_uword_t stack_words = ctx->stack_words;
+            mit_uword_t * const stack_depth_ptr = &ctx->stack_depth;
+            mit_uword_t stack_depth = ctx->stack_depth;
+            mit_uword_t fuel = *fuel_ptr;
+            mit_word_t error;
+
+            // The return stack.
+            struct call_frame *ret_stack = NULL;
+            mit_uword_t ret_depth = 0, ret_words = 0;
+
+            // Resume a run suspended in a call.
+            void * const mark = frame_mark();
+            if (ctx->frames != NULL) {
+                struct suspended_frames *frames = ctx->frames;
+                stack = frames->stack;
+                stack_depth = frames->stack_depth;
+                ret_stack = frames->ret_stack;
+                ret_depth = frames->ret_depth;
+                ret_words = frames->ret_words;
+                frame_attach(frames->chunks, frames->mark);
+                for (mit_uword_t i = 0; i < ret_depth; i++)
+                    if (ret_stack[i].is_catch && ret_stack[i].frames == frames->mark)
+                        ret_stack[i].frames = mark;
+                free(frames);
+                ctx->frames = NULL;
+            }
+            CHECK_STACK_DEPTH;
+
+            loop:
+            for (;;) {''',
+            Code(
                 '''\
-                #undef stack_depth
-                }''',
-            ]),
+                uint8_t opcode = (uint8_t)ir;
+                ir = ARSHIFT(ir, 8);''',
+                run_body(instructions),
+            ),
             '''\
-            error:
-                longjmp(*jmp_buf_ptr, error);
             }
-            #undef run_inner''',
-        )
+
+            suspend:
+            *fuel_ptr = fuel;
+            if (ret_depth == 0) {
+                *stack_depth_ptr = stack_depth;
+                free(ret_stack);
+            } else {
+                struct suspended_frames *frames = malloc(sizeof(struct suspended_frames));
+                if (frames == NULL) {
+                    // The run cannot be suspended, nor can the error be
+                    // caught without running, so abandon the run, leaving
+                    // `ctx->pc` where it started.
+                    *stack_depth_ptr = ret_stack[0].stack_depth;
+                    free(ret_stack);
+                    return MIT_ERROR_STACK_OVERFLOW;
+                }
+                *frames = (struct suspended_frames){
+                    stack, stack_depth, ret_stack, ret_depth, ret_words,
+                    frame_detach(mark), mark
+                };
+                ctx->frames = frames;
+            }
+            // `ir` is 0, as `next` is the only instruction to use `DO_NEXT`.
+            ctx->pc = pc;
+            ctx->ir = 0;
+            return ctx->interrupt ? MIT_ERROR_INTERRUPTED : MIT_ERROR_OUT_OF_FUEL;
+
+            error:
+            *fuel_ptr = fuel;
+            CATCH_FLAT_ERROR(goto loop);''',
+        ),
+        '''\
+        }
+        #undef DO_CALL
+        #undef DO_RET
+        #undef DO_CATCH
+        #undef DO_NEXT
+        #define DO_NEXT ir = *pc++''',
     )
 
-def run_fn(suffix):
+def run_fn(suffix, flat_calls=False):
     '''
     Generate a `mit_run`-like function.
 
      - suffix - str - the function is named `mit_run_{suffix}` and will call
        an inner function `run_inner_{suffix}`.
+     - flat_calls - bool - true if `run_inner_{suffix}` was generated by
+       `inner_fn()` with `resume`, and hence returns an error code rather
+       than calling `longjmp()`.
     '''
+    if flat_calls:
+        return Code(f'''
+            mit_word_t mit_run_{suffix}(mit_word_t *pc, mit_word_t ir, mit_word_t * restrict stack, mit_uword_t stack_words, mit_uword_t *stack_depth_ptr)
+            {{
+                void *frames = frame_mark();
+                mit_word_t error = run_inner_{suffix}(pc, ir, stack, stack_words, stack_depth_ptr);
+                if (error != MIT_ERROR_OK) {{
+                    // Free any frames left behind by the error.
+                    frame_release(frames);
+                }}
+                return error;
+            }}
+            ''',
+        )
     return Code(f'''
         mit_word_t mit_run_{suffix}(mit_word_t *pc, mit_word_t ir, mit_word_t * restrict stack, mit_uword_t stack_words, mit_uword_t *stack_depth_ptr)
         {{
             jmp_buf env;
+            void *frames = frame_mark();
             mit_word_t error = (mit_word_t)setjmp(env);
             if (error == 0) {{
                 run_inner_{suffix}(pc, ir, stack, stack_words, stack_depth_ptr, &env);
                 error = MIT_ERROR_OK;
+            }} else {{
+                // Free any frames left behind by the error.
+                frame_release(frames);
+            }}
+            return error;
+        }}
+        ''',
+    )
+
+def guarded_run_fn(suffix):
+    '''
+    Generate a `mit_run`-like function that runs with a copy of the stack in
+    chunks of the frame arena that are bounded by guard pages, and turns
+    faults in the guard pages into errors.
+
+     - suffix - str - the function is named `mit_run_{suffix}` and will call
+       an inner function `run_inner_{suffix}`, which should not check the
+       stack.
+    '''
+    return Code(f'''
+        mit_word_t mit_run_{suffix}(mit_word_t *pc, mit_word_t ir, mit_word_t * restrict stack, mit_uword_t stack_words, mit_uword_t *stack_depth_ptr)
+        {{
+            if (!fault_install())
+                return mit_run_simple(pc, ir, stack, stack_words, stack_depth_ptr);
+            mit_uword_t stack_depth = *stack_depth_ptr;
+            if (stack_depth > stack_words)
+                return MIT_ERROR_STACK_OVERFLOW;
+            void *frames = frame_mark();
+            mit_word_t *guarded_stack = frame_alloc_guarded(stack, stack_depth, stack_words);
+            if (guarded_stack == NULL)
+                return MIT_ERROR_STACK_OVERFLOW;
+            jmp_buf env, *old_env = guard_env;
+            mit_word_t error = (mit_word_t)setjmp(env);
+            if (error == 0) {{
+                guard_env = &env;
+                run_inner_{suffix}(pc, ir, guarded_stack, stack_words, &stack_depth, &env);
+                error = MIT_ERROR_OK;
+            }}
+            guard_env = old_env;
+            // `stack_depth` may have changed since `setjmp()` returned, so
+            // read it from memory.
+            stack_depth = *(volatile mit_uword_t *)&stack_depth;
+            if (stack_depth > stack_words) {{
+                // The stack may have grown past `stack_words` without
+                // reaching a guard page, or shrunk below zero, wrapping
+                // `stack_depth`, if items were popped without being read.
+                // Leave as many items as `mit_run_simple` would.
+                if ((mit_word_t)stack_depth < 0) {{
+                    stack_depth = 0;
+                    if (error == MIT_ERROR_OK)
+                        error = MIT_ERROR_INVALID_STACK_READ;
+                }} else {{
+                    stack_depth = stack_words;
+                    if (error == MIT_ERROR_OK)
+                        error = MIT_ERROR_STACK_OVERFLOW;
+                }}
             }}
+            // Leave the stack as it was when execution halted.
+            memmove(stack, guarded_stack, stack_depth * sizeof(mit_word_t));
+            *stack_depth_ptr = stack_depth;
+            frame_release(frames);
             return error;
         }}
         ''',
     )
+
+
+# TODO: Unify with path.State?
+class CacheState:
+    '''
+    As an optimization, StackItems that have recently been pushed are cached
+    in C variables, as they are likely to be popped soon.
+    This class represents the current cacheing situation.
+
+    Caching items does not affect `stack_depth`.
+    If `item.depth < self.cached_depth`, then `item` is cached in variable
+    `self.var(item.depth)`.
+
+    Public fields:
+     - cached_depth - the number of items that are cached. Usually we ensure
+       that a C variable `cached_depth` equals `self.cached_depth`. Usually
+       it is a compile-time constant.
+     - checked_depth - the number of items that we know we can push without
+       checking for stack overflow.
+    '''
+    def __init__(self, cached_depth, checked_depth):
+        self.cached_depth = cached_depth
+        self.checked_depth = checked_depth
+
+    def __repr__(self):
+        return f'CacheState({self.cached_depth}, {self.checked_depth})'
+
+    def underflow_test(self, num_pops):
+        '''
+        Returns a C boolean expression (a str) to check that the stack
+        contains enough items to pop the specified number of items.
+         - num_pops - int
+        '''
+        assert type(num_pops) is int
+        if self.cached_depth >= num_pops: return '1'
+        return f'stack_depth >= {num_pops}'
+
+    def overflow_test(self, num_pops, num_pushes):
+        '''
+        Returns a C boolean expression (a str) to check that the stack
+        contains enough space to push `num_pushes` items, given that
+        `num_pops` items will first be popped.
+         - num_pops - int.
+         - num_pushes - int.
+        '''
+        assert type(num_pops) is int
+        assert type(num_pushes) is int
+        depth_change = num_pushes - num_pops
+        if self.checked_depth >= depth_change: return '1'
+        return f'(stack_words - stack_depth) >= {depth_change}'
+
+    def load_args(self, args):
+        '''
+        Returns a Code to read the arguments from the stack into C
+        variables. `stack_depth` is not modified.
+
+         - args - list of str.
+        '''
+        return Code(*[
+            f'{item.name} = {self.lvalue(pos)};'
+            for pos, item in enumerate(reversed(args.items))
+        ])
+
+    def store_results(self, results):
+        '''
+        Returns a Code to write the results from C variables into the
+        stack. `stack_depth` must be modified first.
+
+         - results - list of str.
+        '''
+        return Code(*[
+            f'{self.lvalue(pos)} = {item.name};'
+            for pos, item in enumerate(reversed(results.items))
+        ])
+
+    def add(self, depth_change):
+        '''
+        Returns a Code to update the variable `cached_depth` to reflect
+        a change in the stack depth, e.g. by pushing or popping some items.
+        Also updates `self`.
+
+         - depth_change - int (N.B. not Size)
+        '''
+        assert type(depth_change) is int
+        if depth_change == 0: return Code()
+        self.cached_depth += depth_change
+        if self.cached_depth < 0: self.cached_depth = 0
+        self.checked_depth -= depth_change
+        if self.checked_depth < 0: self.checked_depth = 0
+        return Code(f'cached_depth = {self.cached_depth};')
+
+    def var(self, pos):
+        '''
+        Calculate the name of the stack cache variable for position pos.
+        This is chosen so that `pop()` and `push()` do not require moving
+        values between variables.
+        '''
+        assert 0 <= pos < self.cached_depth
+        return f'stack_{self.cached_depth - 1 - pos}'
+
+    def lvalue(self, pos):
+        '''
+        Returns a C L-value representing the current location of stack
+        position `pos`, whether or not it is cached.
+        '''
+        if pos < self.cached_depth:
+            # The item is cached.
+            return self.var(pos)
+        else:
+            # The item is really on the stack.
+            return f'*mit_stack_pos(stack, stack_depth, {pos})'
+
+    def flush(self, goal=0):
+        '''
+        Decrease the number of stack items that are cached in C variables,
+        if necessary. Returns a Code to move values between variables
+        and to memory. Also updates the C variable `cached_depth`.
+
+         - goal - a CacheState to match, or an int to specify a desired
+           `cache_depth`. Default is `0`.
+        '''
+        if type(goal) is int:
+            goal = CacheState(goal, self.checked_depth)
+        assert goal.cached_depth <= self.cached_depth, (goal, self)
+        assert goal.checked_depth <= self.checked_depth, (goal, self)
+        self.checked_depth = goal.checked_depth
+        if goal.cached_depth == self.cached_depth: return Code()
+        code = Code()
+        for pos in reversed(range(self.cached_depth)):
+            code.append(f'{goal.lvalue(pos)} = {self.lvalue(pos)};')
+        self.cached_depth = goal.cached_depth
+        code.append(f'cached_depth = {self.cached_depth};')
+        return code
+
+
+# The maximum number of stack items cached by `run_inner_cached_fn()`.
+MAX_CACHED_DEPTH = 2
+
+def cached_action_code(action, cached_depth):
+    '''
+    Generate a Code for an Action for `run_inner_cached_fn()`, entered with
+    `cached_depth` stack items cached in C variables.
+
+    Actions whose stack effect is not a fixed number of single-word items
+    flush the cache and run the ordinary code generated by
+    `gen_action_code()`.
+     - action - Action.
+     - cached_depth - int.
+
+    Returns a Code and the number of stack items cached after it has run.
+    '''
+    cache_state = CacheState(cached_depth, 0)
+    effect = action.effect
+    if (
+        effect is None or
+        action.is_variadic or
+        any(item.size != Size(1) for item in effect.by_name.values())
+    ):
+        code = cache_state.flush()
+        code.extend(gen_action_code(action))
+        return code, 0
+
+    num_pops = len(effect.args.items)
+    num_pushes = len(effect.results.items)
+    code = Code()
+    code.extend(declare_vars(effect))
+    if cached_depth < num_pops:
+        code.extend(check_underflow(Size(num_pops)))
+    code.extend(check_overflow(Size(num_pops), Size(num_pushes)))
+    code.extend(cache_state.load_args(effect.args))
+    # Note: `stack_depth` and `cached_depth` must be correct for THROW().
+    code.extend(action.code)
+    code.append(f'stack_depth += {num_pushes - num_pops};')
+
+    # Compute the new cache state. The remaining cached items keep their
+    # C variables, so that popping does not move any values.
+    remaining = max(cached_depth - num_pops, 0)
+    total = remaining + num_pushes
+    new_state = CacheState(min(total, MAX_CACHED_DEPTH), 0)
+    # Move the items that were already cached, deepest first so that no
+    # variable is overwritten before it is read.
+    for pos in reversed(range(num_pushes, total)):
+        old_var = f'stack_{total - 1 - pos}'
+        if new_state.lvalue(pos) != old_var:
+            code.append(f'{new_state.lvalue(pos)} = {old_var};')
+    # Store the results.
+    for pos, item in enumerate(reversed(effect.results.items)):
+        code.append(f'{new_state.lvalue(pos)} = {item.name};')
+    if new_state.cached_depth != cached_depth:
+        code.append(f'cached_depth = {new_state.cached_depth};')
+    return code, new_state.cached_depth
+
+def gen_cached_action_code(action, cached_depth):
+    '''
+    Generate a Code for an Action for `run_inner_cached_fn()`. See
+    `cached_action_code()`. The Code ends by jumping to the label for the
+    resulting cache state.
+    '''
+    code, new_depth = cached_action_code(action, cached_depth)
+    code.append(f'goto cached_{new_depth};')
+    return code
+
+def gen_cached_instruction_code(instruction, cached_depth):
+    '''
+    Generate a Code for an Instruction for `run_inner_cached_fn()`. See
+    `gen_cached_action_code()`.
+    '''
+    code = gen_cached_action_code(instruction.action, cached_depth)
+    if instruction.terminal is not None:
+        ir_all_bits = 0 if instruction.opcode & 0x80 == 0 else -1
+        code = Code(
+            f'if (ir != {ir_all_bits}) {{',
+            gen_cached_action_code(instruction.terminal, cached_depth),
+            '} else {',
+            code,
+            '}',
+        )
+    return code
+
+@dataclass
+class InstructionPair:
+    '''
+    A pair of instructions that occur consecutively in `ir`, and are
+    dispatched together by `run_inner_cached_fn()`.
+
+     - first - Instruction - must not be terminal, and must have a stack
+       effect, so that it does not affect `ir` or the stack frame.
+     - second - Instruction.
+    '''
+    first: object
+    second: object
+
+    def __post_init__(self):
+        assert self.first.terminal is None
+        assert self.first.action.effect is not None
+
+def extended_instructions(instructions, extensions):
+    '''
+    Returns an ActionEnum containing `instructions` followed by
+    `extensions`, which are numbered from `0x100`.
+
+     - instructions - ActionEnum - instruction set, with 8-bit opcodes.
+     - extensions - list of (str, action) - names and actions.
+    '''
+    return ActionEnum(instructions.__name__, [
+        *((i.name, (i.action, i.opcode)) for i in instructions),
+        *(
+            (name, (action, 0x100 + n))
+            for n, (name, action) in enumerate(extensions)
+        ),
+    ])
+
+def pair_instructions(instructions, pairs):
+    '''
+    Returns an ActionEnum containing `instructions` followed by an
+    InstructionPair for each pair in `pairs`. The pairs are numbered from
+    `0x100`.
+
+     - instructions - ActionEnum - instruction set, with 8-bit opcodes.
+     - pairs - list of pairs of `instructions`.
+    '''
+    return extended_instructions(instructions, [
+        (f'{first.name}_{second.name}', InstructionPair(first.action, second.action))
+        for first, second in pairs
+    ])
+
+def pair_dispatch_code(actions, pairs):
+    '''
+    Generate declarations for dispatching on pairs of instructions: a table
+    `pair_index` mapping the bottom 16 bits of `ir` to one more than the
+    index in `pairs` of the pair of instructions that it encodes, or 0 for
+    other pairs, and C constants for the opcodes of `actions` from `0x100`
+    onwards, as used by `dispatch_table()`.
+
+     - actions - ActionEnum - the result of `extended_instructions()` with
+       one extension per pair.
+     - pairs - list of pairs of Instructions.
+    '''
+    assert len(pairs) < 0x100
+    return Code(
+        'static const uint8_t pair_index[0x10000] = {',
+        Code(*(
+            f'[{(second.opcode << 8) | first.opcode:#06x}] = {n + 1}, // {first.name} {second.name}'
+            for n, (first, second) in enumerate(pairs)
+        )),
+        '};',
+        'enum {',
+        Code(*(
+            f'{c_symbol(actions.__name__)}_{value.name} = {value.opcode:#x},'
+            for value in actions
+            if value.opcode >= 0x100
+        )),
+        '};',
+    )
+
+# Decode an opcode for dispatch with `pair_dispatch_code()`.
+PAIR_DECODE = '''\
+    mit_uword_t opcode = pair_index[(uint16_t)ir];
+    if (opcode == 0)
+        opcode = (uint8_t)ir;
+    else
+        opcode += 0xff;
+    ir = ARSHIFT(ir, 8);'''
+
+def gen_cached_pair_code(pair, cached_depth):
+    '''
+    Generate a Code for an InstructionPair for `run_inner_cached_fn()`. See
+    `gen_cached_action_code()`.
+    '''
+    code, new_depth = cached_action_code(pair.first.action, cached_depth)
+    return Code(
+        '{',
+        code,
+        '}',
+        'ir = ARSHIFT(ir, 8);',
+        *gen_cached_instruction_code(pair.second, new_depth).buffer,
+    )
+
+def run_inner_cached_fn(instructions, suffix, pairs=()):
+    '''
+    Generate a `run_inner` function that caches up to `MAX_CACHED_DEPTH`
+    top-most stack items in C variables. There is a copy of the main loop
+    for each number of cached items; each instruction jumps to the copy for
+    the cache state that it leaves behind. `call` and `catch` do not
+    recurse; see `DO_CALL_FLAT` and `DO_CATCH_FLAT`.
+
+    Frequent pairs of instructions can be dispatched together on the bottom
+    16 bits of `ir`, which saves one dispatch per pair; other instructions
+    are dispatched on the bottom 8 bits as usual.
+
+     - instructions - ActionEnum - instruction set.
+     - suffix - str - the function is named `run_inner_{suffix}`.
+     - pairs - list of pairs of `instructions` - the pairs to dispatch
+       together; see `InstructionPair` for restrictions.
+    '''
+    code = Code()
+    if len(pairs) > 0:
+        actions = pair_instructions(instructions, pairs)
+        code.extend(pair_dispatch_code(actions, pairs))
+        code.append('')
+    else:
+        actions = instructions
+    code.append('''\
+        // The number of stack items cached in C variables.
+        int cached_depth = 0;''')
+    code.append('mit_word_t {};'.format(', '.join(
+        f'stack_{i} = 0' for i in range(MAX_CACHED_DEPTH)
+    )))
+    code.append('')
+    code.append('CHECK_STACK_DEPTH;')
+    if len(pairs) > 0:
+        decode = PAIR_DECODE
+    else:
+        decode = '''\
+            uint8_t opcode = (uint8_t)ir;
+            ir = ARSHIFT(ir, 8);'''
+    def gen_code(instruction, depth):
+        if isinstance(instruction, InstructionPair):
+            return gen_cached_pair_code(instruction, depth)
+        return gen_cached_instruction_code(instruction, depth)
+    for depth in range(MAX_CACHED_DEPTH + 1):
+        code.append('')
+        code.append(f'cached_{depth}:')
+        code.append(Code(
+            '{',
+            Code(decode),
+            Code(dispatch_table(
+                actions,
+                Code(
+                    '// Undefined instruction.',
+                    'THROW(MIT_ERROR_INVALID_OPCODE);'
+                ),
+                gen_code=lambda instruction: gen_code(instruction, depth),
+                table=f'dispatch_{depth}',
+                size=(1 << 8) + len(pairs),
+                bounded=False,
+            )),
+            '}',
+        ))
+    # On error, flush the cache.
+    switch_code = Code()
+    cache_state = CacheState(MAX_CACHED_DEPTH, 0)
+    while cache_state.cached_depth > 0:
+        switch_code.append(f'case {cache_state.cached_depth}:')
+        case_code = cache_state.flush(cache_state.cached_depth - 1)
+        case_code.append('// Falls through.')
+        switch_code.append(case_code)
+    switch_code.append('''\
+        case 0:
+            break;
+        default:
+            assert(0); // Unreachable.''')
+    error_code = Code(
+        'switch (cached_depth) {',
+        switch_code,
+        '}',
+    )
+    return inner_fn(suffix, code, error_code, resume='goto cached_0')
+
+
+def is_fusable(instruction):
+    '''
+    Tests whether a member of Instructions can be part of a
+    Superinstruction: it must not be terminal, and must have a fixed stack
+    effect of single-word items, so that it does not affect `ir` or the
+    stack frame.
+    '''
+    action = instruction.action.action
+    return (
+        instruction.action.terminal is None and
+        action.effect is not None and
+        not action.is_variadic and
+        all(item.size == Size(1) for item in action.effect.by_name.values())
+    )
+
+@dataclass
+class Superinstruction:
+    '''
+    A sequence of instructions that occur consecutively in `ir`, and are
+    executed by `run_inner_super_fn()` after a single dispatch and a single
+    stack check.
+
+     - instructions - tuple of Instructions - at least two fusable
+       instructions (see `is_fusable()`).
+
+    Public fields:
+     - num_pops - int - the number of stack items that the sequence reads
+       below the initial stack depth.
+     - num_pushes - int - the greatest amount by which the sequence raises
+       the stack depth above its initial value.
+    '''
+    instructions: tuple
+
+    def __post_init__(self):
+        assert len(self.instructions) >= 2
+        assert all(is_fusable(i) for i in self.instructions), self
+        # Merge the stack effects.
+        stack_pos = 0
+        self.num_pops = 0
+        self.num_pushes = 0
+        for instruction in self.instructions:
+            effect = instruction.action.action.effect
+            stack_pos -= len(effect.args.items)
+            self.num_pops = max(self.num_pops, -stack_pos)
+            stack_pos += len(effect.results.items)
+            self.num_pushes = max(self.num_pushes, stack_pos)
+
+    @property
+    def name(self):
+        return '_'.join(i.name for i in self.instructions)
+
+def gen_superinstruction_code(superinstruction):
+    '''
+    Generate a Code for a Superinstruction, to be run when the first
+    instruction has been removed from `ir`. Runs the instructions'
+    actions if the stack check passes; otherwise, falls back to running
+    just the first instruction, so that any error is raised exactly as it
+    would be without fusion.
+    '''
+    tests = []
+    if superinstruction.num_pops > 0:
+        tests.append(f'stack_depth >= {superinstruction.num_pops}')
+    if superinstruction.num_pushes > 0:
+        tests.append(f'stack_words - stack_depth >= {superinstruction.num_pushes}')
+    code = Code()
+    for instruction in superinstruction.instructions:
+        code.append('{')
+        code.append(gen_action_code(instruction.action.action, check=False))
+        code.append('}')
+    code.append(f'ir = ARSHIFT(ir, {8 * (len(superinstruction.instructions) - 1)});')
+    if len(tests) == 0:
+        return code
+    return Code(
+        'if (likely({})) {{'.format(' && '.join(tests)),
+        code,
+        '} else {',
+        gen_instruction_code(superinstruction.instructions[0].action),
+        '}',
+    )
+
+@dataclass
+class SuperinstructionGroup:
+    '''
+    The Superinstructions that start with the same two instructions, which
+    `run_inner_super_fn()` dispatches on together.
+
+     - first - Instructions - the first instruction.
+     - superinstructions - list of Superinstruction.
+    '''
+    first: object
+    superinstructions: list
+
+def gen_superinstruction_group_code(group):
+    '''
+    Generate a Code for a SuperinstructionGroup, to be run when the first
+    instruction has been removed from `ir`. Runs the longest
+    Superinstruction that matches `ir`, or if none does, the first
+    instruction on its own.
+    '''
+    code = Code()
+    for superinstruction in sorted(
+        group.superinstructions,
+        key=lambda s: len(s.instructions),
+        reverse=True,
+    ):
+        rest = superinstruction.instructions[1:]
+        if len(rest) == 1:
+            # The dispatch has already matched the second instruction.
+            code.append('{')
+            code.append(gen_superinstruction_code(superinstruction))
+            code.append('}')
+            return code
+        mask = (1 << (8 * len(rest))) - 1
+        pattern = sum(i.opcode << (8 * n) for n, i in enumerate(rest))
+        code.append(f'if (((mit_uword_t)ir & {mask:#x}) == {pattern:#x}) {{')
+        code.append(gen_superinstruction_code(superinstruction))
+        code.append('} else')
+    code.append('{')
+    code.append(gen_instruction_code(group.first.action))
+    code.append('}')
+    return code
+
+def run_inner_super_fn(instructions, suffix, superinstructions):
+    '''
+    Generate a `run_inner` function that executes each of the given
+    sequences of instructions as a Superinstruction. Superinstructions are
+    dispatched on the bottom 16 bits of `ir`; other instructions are
+    dispatched on the bottom 8 bits as usual.
+
+     - instructions - ActionEnum - instruction set.
+     - suffix - str - the function is named `run_inner_{suffix}`.
+     - superinstructions - list of tuples of `instructions` - the sequences
+       to fuse; each must satisfy the conditions of `Superinstruction`, and
+       must be no longer than the number of opcodes in a word. If there are
+       none, the function is the same as `run_inner_simple`.
+    '''
+    if len(superinstructions) == 0:
+        return run_inner_fn(instructions, suffix, '')
+    groups = {}
+    for sequence in superinstructions:
+        group = groups.setdefault(
+            (sequence[0], sequence[1]),
+            SuperinstructionGroup(sequence[0], []),
+        )
+        group.superinstructions.append(Superinstruction(tuple(sequence)))
+    pairs = list(groups)
+    actions = extended_instructions(instructions, [
+        (f'{first.name}_{second.name}', group)
+        for (first, second), group in groups.items()
+    ])
+    def gen_code(instruction):
+        if isinstance(instruction, SuperinstructionGroup):
+            return gen_superinstruction_group_code(instruction)
+        return gen_instruction_code(instruction)
+    return inner_fn(suffix, Code(
+        *pair_dispatch_code(actions, pairs).buffer,
+        '',
+        '''\
+        CHECK_STACK_DEPTH;
+        for (;;) {''',
+        Code(
+            PAIR_DECODE,
+            dispatch_table(
+                actions,
+                Code(
+                    '// Undefined instruction.',
+                    'THROW(MIT_ERROR_INVALID_OPCODE);'
+                ),
+                gen_code=gen_code,
+                size=(1 << 8) + len(pairs),
+                bounded=False,
+            ),
+        ),
+        '}',
+    ))
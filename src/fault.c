@@ -0,0 +1,70 @@
+// Handle faults in guard pages and watched pages.
+//
+// (c) Mit authors 2020
+//
+// The package is distributed under the MIT/X11 License.
+//
+// THIS PROGRAM IS PROVIDED AS IS, WITH NO WARRANTY. USE IS AT THE USER’S
+// RISK.
+
+#include "config.h"
+
+#include <stdbool.h>
+#include <string.h>
+
+#include "mit/mit.h"
+
+#include "run.h"
+
+#if FAULT_HANDLER
+#include <pthread.h>
+#include <signal.h>
+
+
+// The action for SIGSEGV before `fault_install()`.
+static struct sigaction old_sigsegv_action;
+static bool installed = false;
+static pthread_once_t install_once = PTHREAD_ONCE_INIT;
+
+// Pass a fault to `guard_fault()`, which does not return if it handles it,
+// and then to `watch_fault()`. If neither handles it, pass it on to the
+// previous action.
+static void fault_handler(int sig, siginfo_t *info, void *context)
+{
+    guard_fault(info->si_addr);
+    if (watch_fault(info->si_addr))
+        return;
+
+    if (old_sigsegv_action.sa_flags & SA_SIGINFO)
+        old_sigsegv_action.sa_sigaction(sig, info, context);
+    else if (old_sigsegv_action.sa_handler != SIG_DFL &&
+             old_sigsegv_action.sa_handler != SIG_IGN)
+        old_sigsegv_action.sa_handler(sig);
+    else {
+        // The default action ends the process, which this handler cannot
+        // do while leaving it installed: reset it, and repeat the fault,
+        // by returning to it, or by raising the signal if it was sent.
+        signal(SIGSEGV, SIG_DFL);
+        if (info->si_code <= 0)
+            raise(SIGSEGV);
+    }
+}
+
+static void install(void)
+{
+    struct sigaction action;
+    memset(&action, 0, sizeof(action));
+    action.sa_sigaction = fault_handler;
+    // `guard_fault()` does not return after a stack error, so SIGSEGV must
+    // not be blocked while the handler runs.
+    action.sa_flags = SA_SIGINFO | SA_NODEFER;
+    sigemptyset(&action.sa_mask);
+    installed = sigaction(SIGSEGV, &action, &old_sigsegv_action) == 0;
+}
+
+bool fault_install(void)
+{
+    (void)pthread_once(&install_once, install);
+    return installed;
+}
+#endif
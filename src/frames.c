@@ -0,0 +1,319 @@
+// Allocate stack frames and return stacks for `call` and `catch`.
+//
+// (c) Mit authors 2020
+//
+// The package is distributed under the MIT/X11 License.
+//
+// THIS PROGRAM IS PROVIDED AS IS, WITH NO WARRANTY. USE IS AT THE USER’S
+// RISK.
+
+#include "config.h"
+
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+
+#include "mit/mit.h"
+
+#include "run.h"
+
+#ifdef HAVE_PTHREAD_H
+#include <pthread.h>
+#endif
+
+#if GUARD_PAGES
+#include <sys/mman.h>
+#include <unistd.h>
+#endif
+
+
+MIT_THREAD_LOCAL mit_uword_t mit_max_call_depth = 0x100000;
+
+// The number of words of a chunk of the arena beyond `stack_words`, which
+// frames can fill before a new chunk is needed.
+#define CHUNK_WORDS 0x10000U
+
+// Frames are allocated in a per-thread stack of chunks. A chunk is either
+// allocated along with its header, or, if it is `guarded`, mapped with a
+// guard page before `words` and after `end`.
+struct chunk {
+    struct chunk *prev;
+    mit_word_t *words;
+    mit_word_t *end;
+    bool guarded;
+};
+
+// Each thread has the innermost chunk it is using, and the chunk it most
+// recently freed, which is kept to avoid repeated allocation when a call
+// crosses a chunk boundary in a loop. Without thread-local storage, they
+// are the values of pthread keys, so that threads never share chunks.
+#if !defined(HAVE_THREAD_LOCAL) && defined(HAVE_PTHREAD_H)
+#define ARENA_KEYS 1
+#else
+#define ARENA_KEYS 0
+static MIT_THREAD_LOCAL struct chunk *current_chunk = NULL;
+static MIT_THREAD_LOCAL struct chunk *spare_chunk = NULL;
+#endif
+
+#if GUARD_PAGES
+static size_t page_size;
+#endif
+
+// Allocate a chunk of at least `words` words, `guarded` if requested.
+// Returns `NULL` if out of memory.
+static struct chunk *chunk_new(mit_uword_t words, bool guarded)
+{
+    struct chunk *chunk;
+#if GUARD_PAGES
+    if (guarded) {
+        if (page_size == 0)
+            page_size = (size_t)sysconf(_SC_PAGESIZE);
+        if (words > (SIZE_MAX - 3 * page_size) / sizeof(mit_word_t))
+            return NULL;
+        size_t bytes = (words * sizeof(mit_word_t) + page_size - 1) & ~(page_size - 1);
+        chunk = malloc(sizeof(struct chunk));
+        if (chunk == NULL)
+            return NULL;
+        char *mapping = mmap(NULL, bytes + 2 * page_size, PROT_NONE,
+                             MAP_PRIVATE | MAP_ANONYMOUS, -1, 0);
+        if (mapping == MAP_FAILED) {
+            free(chunk);
+            return NULL;
+        }
+        if (mprotect(mapping + page_size, bytes, PROT_READ | PROT_WRITE) != 0) {
+            munmap(mapping, bytes + 2 * page_size);
+            free(chunk);
+            return NULL;
+        }
+        chunk->words = (mit_word_t *)(mapping + page_size);
+        chunk->end = (mit_word_t *)(mapping + page_size + bytes);
+        chunk->guarded = true;
+        return chunk;
+    }
+#else
+    (void)guarded;
+#endif
+    if (words > (SIZE_MAX - sizeof(struct chunk)) / sizeof(mit_word_t))
+        return NULL;
+    chunk = malloc(sizeof(struct chunk) + words * sizeof(mit_word_t));
+    if (chunk == NULL)
+        return NULL;
+    chunk->words = (mit_word_t *)(chunk + 1);
+    chunk->end = chunk->words + words;
+    chunk->guarded = false;
+    return chunk;
+}
+
+static void chunk_free(struct chunk *chunk)
+{
+#if GUARD_PAGES
+    if (chunk->guarded)
+        munmap((char *)chunk->words - page_size,
+               (size_t)((char *)chunk->end - (char *)chunk->words) + 2 * page_size);
+#endif
+    free(chunk);
+}
+
+#ifdef HAVE_PTHREAD_H
+// A key whose value is the spare chunk of a thread, so that it can be freed
+// when the thread exits, and, if ARENA_KEYS is set, one whose value is its
+// current chunk.
+static pthread_key_t spare_chunk_key;
+#if ARENA_KEYS
+static pthread_key_t current_chunk_key;
+#endif
+static pthread_once_t keys_once = PTHREAD_ONCE_INIT;
+
+static void spare_chunk_destroy(void *chunk)
+{
+#if !ARENA_KEYS
+    if (spare_chunk == chunk)
+        spare_chunk = NULL;
+#endif
+    chunk_free(chunk);
+}
+
+static void keys_create(void)
+{
+    (void)pthread_key_create(&spare_chunk_key, spare_chunk_destroy);
+#if ARENA_KEYS
+    (void)pthread_key_create(&current_chunk_key, NULL);
+#endif
+}
+#endif
+
+static struct chunk *get_current_chunk(void)
+{
+#if ARENA_KEYS
+    (void)pthread_once(&keys_once, keys_create);
+    return pthread_getspecific(current_chunk_key);
+#else
+    return current_chunk;
+#endif
+}
+
+// Returns false if the chunk could not be set.
+static bool set_current_chunk(struct chunk *chunk)
+{
+#if ARENA_KEYS
+    (void)pthread_once(&keys_once, keys_create);
+    return pthread_setspecific(current_chunk_key, chunk) == 0;
+#else
+    current_chunk = chunk;
+    return true;
+#endif
+}
+
+static struct chunk *get_spare_chunk(void)
+{
+#if ARENA_KEYS
+    (void)pthread_once(&keys_once, keys_create);
+    return pthread_getspecific(spare_chunk_key);
+#else
+    return spare_chunk;
+#endif
+}
+
+static void set_spare_chunk(struct chunk *chunk)
+{
+#if !ARENA_KEYS
+    spare_chunk = chunk;
+#endif
+#ifdef HAVE_PTHREAD_H
+    (void)pthread_once(&keys_once, keys_create);
+    (void)pthread_setspecific(spare_chunk_key, chunk);
+#endif
+}
+
+static void pop_chunk(void)
+{
+    struct chunk *chunk = get_current_chunk();
+    (void)set_current_chunk(chunk->prev);
+    if (get_spare_chunk() == NULL)
+        set_spare_chunk(chunk);
+    else
+        chunk_free(chunk);
+}
+
+// Start a new chunk for `frame_alloc()`, `guarded` if requested.
+static mit_word_t *chunk_alloc(mit_word_t *base, mit_uword_t nargs, mit_uword_t stack_words, bool guarded)
+{
+    // Frames after this one start at their callers' arguments, so they only
+    // use as much of the chunk as their callers do; the chunk only runs out
+    // when the frames in it use more than CHUNK_WORDS words.
+    if (stack_words > MIT_UWORD_MAX - CHUNK_WORDS)
+        return NULL;
+    mit_uword_t words = stack_words + CHUNK_WORDS;
+    struct chunk *chunk = get_spare_chunk();
+    if (chunk != NULL && chunk->guarded == guarded &&
+        (mit_uword_t)(chunk->end - chunk->words) >= words)
+        set_spare_chunk(NULL);
+    else {
+        chunk = chunk_new(words, guarded);
+        if (chunk == NULL)
+            return NULL;
+    }
+    chunk->prev = get_current_chunk();
+    if (!set_current_chunk(chunk)) {
+        chunk_free(chunk);
+        return NULL;
+    }
+    memcpy(chunk->words, base, nargs * sizeof(mit_word_t));
+    return chunk->words;
+}
+
+mit_word_t *frame_alloc(mit_word_t *base, mit_uword_t nargs, mit_uword_t stack_words)
+{
+    // If the frame fits in the current chunk, use the caller's argument
+    // slots directly.
+    struct chunk *current = get_current_chunk();
+    if (current != NULL) {
+        uintptr_t addr = (uintptr_t)base;
+        if (addr >= (uintptr_t)current->words &&
+            addr <= (uintptr_t)current->end &&
+            (mit_uword_t)(current->end - base) >= stack_words)
+            return base;
+    }
+
+    // Otherwise, start a new chunk like the current one, and copy the
+    // arguments into it.
+    return chunk_alloc(base, nargs, stack_words,
+                       current != NULL && current->guarded);
+}
+
+#if GUARD_PAGES
+mit_word_t *frame_alloc_guarded(mit_word_t *base, mit_uword_t nargs, mit_uword_t stack_words)
+{
+    return chunk_alloc(base, nargs, stack_words, true);
+}
+#endif
+
+void frame_free(void)
+{
+    pop_chunk();
+}
+
+void *frame_mark(void)
+{
+    return get_current_chunk();
+}
+
+void frame_release(void *mark)
+{
+    while (get_current_chunk() != mark)
+        pop_chunk();
+}
+
+void *frame_detach(void *mark)
+{
+    struct chunk *chunks = get_current_chunk();
+    (void)set_current_chunk(mark);
+    return chunks != mark ? chunks : NULL;
+}
+
+void frame_attach(void *chunks, void *mark)
+{
+    if (chunks == NULL)
+        return;
+    struct chunk *chunk = chunks;
+    while (chunk->prev != mark)
+        chunk = chunk->prev;
+    chunk->prev = get_current_chunk();
+    (void)set_current_chunk(chunks);
+}
+
+#if GUARD_PAGES
+MIT_THREAD_LOCAL jmp_buf *guard_env = NULL;
+
+void guard_fault(void *addr)
+{
+    if (guard_env == NULL)
+        return;
+    uintptr_t a = (uintptr_t)addr;
+    for (struct chunk *chunk = get_current_chunk(); chunk != NULL; chunk = chunk->prev) {
+        if (!chunk->guarded)
+            continue;
+        uintptr_t words = (uintptr_t)chunk->words, end = (uintptr_t)chunk->end;
+        if (a >= end && a - end < page_size)
+            longjmp(*guard_env, MIT_ERROR_STACK_OVERFLOW);
+        if (a < words && words - a <= page_size)
+            longjmp(*guard_env, MIT_ERROR_INVALID_STACK_READ);
+    }
+}
+#endif
+
+struct call_frame *call_frames_grow(struct call_frame *frames, mit_uword_t *words_ptr)
+{
+    mit_uword_t words = *words_ptr;
+    if (words >= mit_max_call_depth)
+        return NULL;
+    words = words == 0 ? 64 : words * 2;
+    if (words > mit_max_call_depth)
+        words = mit_max_call_depth;
+    if (words > SIZE_MAX / sizeof(struct call_frame))
+        return NULL;
+    frames = realloc(frames, words * sizeof(struct call_frame));
+    if (frames != NULL)
+        *words_ptr = words;
+    return frames;
+}
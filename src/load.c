@@ -0,0 +1,71 @@
+// Load files into memory, mapping them where possible.
+//
+// (c) Mit authors 2020
+//
+// The package is distributed under the MIT/X11 License.
+//
+// THIS PROGRAM IS PROVIDED AS IS, WITH NO WARRANTY. USE IS AT THE USER’S
+// RISK.
+
+#include "config.h"
+
+#include <errno.h>
+#include <stdint.h>
+#include <unistd.h>
+
+#include "mit/mit.h"
+
+#if defined(HAVE_SYS_MMAN_H) && defined(HAVE_MMAP)
+#include <sys/mman.h>
+#define MAP_FILES 1
+#else
+#define MAP_FILES 0
+#endif
+
+
+// Read `length` bytes from `fd` at `offset` into `buf`.
+static int read_range(int fd, off_t offset, char *buf, size_t length)
+{
+    if (length == 0)
+        return 0;
+    if (lseek(fd, offset, SEEK_SET) == -1)
+        return -1;
+    while (length > 0) {
+        ssize_t n = read(fd, buf, length);
+        if (n == -1) {
+            if (errno == EINTR)
+                continue;
+            return -1;
+        } else if (n == 0) {
+            errno = EIO;
+            return -1;
+        }
+        buf += n;
+        length -= (size_t)n;
+    }
+    return 0;
+}
+
+int mit_load_file(int fd, off_t offset, size_t length, void *addr)
+{
+    char *start = addr, *end = start + length;
+#if MAP_FILES
+    // Map the whole pages of the destination, if their offsets in the file
+    // are aligned to a page.
+    uintptr_t page_size = (uintptr_t)sysconf(_SC_PAGESIZE);
+    if (((uintptr_t)start - (uintptr_t)offset) % page_size == 0) {
+        char *map_start = (char *)(((uintptr_t)start + page_size - 1) & ~(page_size - 1));
+        char *map_end = (char *)((uintptr_t)end & ~(page_size - 1));
+        if (map_start < map_end &&
+            mmap(map_start, (size_t)(map_end - map_start),
+                 PROT_READ | PROT_WRITE, MAP_PRIVATE | MAP_FIXED,
+                 fd, offset + (map_start - start)) != MAP_FAILED) {
+            if (read_range(fd, offset, start, (size_t)(map_start - start)) != 0)
+                return -1;
+            return read_range(fd, offset + (map_end - start), map_end,
+                              (size_t)(end - map_end));
+        }
+    }
+#endif
+    return read_range(fd, offset, start, length);
+}
@@ -0,0 +1,36 @@
+// Restore memory from snapshots.
+//
+// (c) Mit authors 2020
+//
+// The package is distributed under the MIT/X11 License.
+//
+// THIS PROGRAM IS PROVIDED AS IS, WITH NO WARRANTY. USE IS AT THE USER’S
+// RISK.
+
+#include "config.h"
+
+#include <stdint.h>
+#include <string.h>
+
+#include "mit/mit.h"
+
+
+size_t mit_restore_pages(void *dst, const void *src, size_t length, size_t page_size, const uint8_t *dirty)
+{
+    size_t copied = 0;
+    uintptr_t begin = (uintptr_t)dst, end = begin + length;
+    uintptr_t page = begin & ~(uintptr_t)(page_size - 1);
+    for (size_t i = 0; page < end; i++, page += page_size) {
+        if (dirty != NULL && (dirty[i / 8] & (1 << (i % 8))) == 0)
+            continue;
+        // The part of the page in [dst, dst + length).
+        uintptr_t from = page > begin ? page : begin;
+        uintptr_t to = page + page_size < end ? page + page_size : end;
+        size_t offset = from - begin, bytes = to - from;
+        if (memcmp((char *)dst + offset, (const char *)src + offset, bytes) != 0) {
+            memcpy((char *)dst + offset, (const char *)src + offset, bytes);
+            copied++;
+        }
+    }
+    return copied;
+}
@@ -15,7 +15,7 @@ from autonumber import AutoNumber
 from stack import StackEffect
 from action import Action, ActionEnum
 from code_util import Code
-from code_gen import dispatch
+from code_gen import dispatch_table
 
 
 word_bytes = sizeof(c_size_t)
@@ -46,6 +46,8 @@ class MitErrorCode(IntEnum):
     UNALIGNED_ADDRESS = -8
     DIVISION_BY_ZERO = -9
     DIVISION_OVERFLOW = -10
+    INTERRUPTED = -124
+    OUT_OF_FUEL = -125
     BREAK = -126
 
 
@@ -96,8 +98,7 @@ class ExtraInstructions(ActionEnum):
                   # understand multiple stack frames.
             Code('''\
                 POP(addr);
-                if (unlikely(addr % sizeof(mit_word_t) != 0))
-                   THROW(MIT_ERROR_UNALIGNED_ADDRESS);
+                CHECK_ALIGNED(addr, sizeof(mit_word_t));
                 DO_CATCH(addr);
             '''),
         ),
@@ -125,12 +126,13 @@ extra_code = Code('''\
     mit_uword_t extra_opcode = ir;
     ir = 0;
 ''')
-extra_code.extend(dispatch(
+extra_code.extend(dispatch_table(
     ExtraInstructions,
     Code(
         'THROW(MIT_ERROR_INVALID_OPCODE);',
     ),
     'extra_opcode',
+    table='extra',
 ))
 
 
@@ -309,8 +311,7 @@ instructions = [
             None, # Manage stack manually because of changing stack frames.
             Code('''\
                 POP(addr);
-                if (unlikely(addr % sizeof(mit_word_t) != 0))
-                   THROW(MIT_ERROR_UNALIGNED_ADDRESS);
+                CHECK_ALIGNED(addr, sizeof(mit_word_t));
                 DO_CALL(addr);
             '''),
         ),
@@ -327,10 +328,8 @@ instructions = [
         'name': 'RET',
         'opcode': 0x0f,
         'action': Action(
-            None,
-            # `call` or `catch` performs the rest of the action of `ret` on
-            # return from `run_inner()`.
-            Code('return;'),
+            None, # Manage stack manually because of changing stack frames.
+            Code('DO_RET;'),
         ),
     },
 
@@ -340,8 +339,7 @@ instructions = [
         'action': Action(
             StackEffect.of(['addr'], ['val']),
             Code('''\
-                if (unlikely(addr % sizeof(mit_word_t) != 0))
-                    THROW(MIT_ERROR_UNALIGNED_ADDRESS);
+                CHECK_ALIGNED(addr, sizeof(mit_word_t));
                 val = *(mit_word_t *)addr;
             '''),
         ),
@@ -353,8 +351,7 @@ instructions = [
         'action': Action(
             StackEffect.of(['val', 'addr'], []),
             Code('''\
-                if (unlikely(addr % sizeof(mit_word_t) != 0))
-                    THROW(MIT_ERROR_UNALIGNED_ADDRESS);
+                CHECK_ALIGNED(addr, sizeof(mit_word_t));
                 *(mit_word_t *)addr = val;
             '''),
         ),
@@ -384,8 +381,7 @@ instructions = [
         'action': Action(
             StackEffect.of(['addr'], ['val']),
             Code('''\
-                if (unlikely(addr % 2 != 0))
-                    THROW(MIT_ERROR_UNALIGNED_ADDRESS);
+                CHECK_ALIGNED(addr, 2);
                 val = (mit_uword_t)*((uint16_t *)addr);
             '''),
         ),
@@ -397,8 +393,7 @@ instructions = [
         'action': Action(
             StackEffect.of(['val', 'addr'], []),
             Code('''\
-                if (unlikely(addr % 2 != 0))
-                    THROW(MIT_ERROR_UNALIGNED_ADDRESS);
+                CHECK_ALIGNED(addr, 2);
                 *(uint16_t *)addr = (uint16_t)val;
             '''),
         ),
@@ -410,8 +405,7 @@ instructions = [
         'action': Action(
             StackEffect.of(['addr'], ['val']),
             Code('''\
-                if (unlikely(addr % 4 != 0))
-                    THROW(MIT_ERROR_UNALIGNED_ADDRESS);
+                CHECK_ALIGNED(addr, 4);
                 val = (mit_uword_t)*((uint32_t *)addr);
             '''),
         ),
@@ -423,8 +417,7 @@ instructions = [
         'action': Action(
             StackEffect.of(['val', 'addr'], []),
             Code('''\
-                if (unlikely(addr % 4 != 0))
-                    THROW(MIT_ERROR_UNALIGNED_ADDRESS);
+                CHECK_ALIGNED(addr, 4);
                 *(uint32_t *)addr = (uint32_t)val;
             '''),
         ),
@@ -525,6 +518,7 @@ instructions.extend([
                     mit_word_t inner_error = mit_trap(pc, ir, stack, stack_words, &stack_depth);
                     if (inner_error != MIT_ERROR_OK)
                         THROW(inner_error);
+                    CHECK_STACK_DEPTH;
                 }
             '''),
         ),
@@ -0,0 +1,120 @@
+// Watch writes to memory with page protection, for `mit_run_watch`.
+//
+// (c) Mit authors 2020
+//
+// The package is distributed under the MIT/X11 License.
+//
+// THIS PROGRAM IS PROVIDED AS IS, WITH NO WARRANTY. USE IS AT THE USER’S
+// RISK.
+
+#include "config.h"
+
+#include <stdint.h>
+#include <string.h>
+
+#include "mit/mit.h"
+
+#include "run.h"
+
+#if WATCHPOINTS
+#include <sys/mman.h>
+#include <unistd.h>
+#endif
+
+
+MIT_THREAD_LOCAL mit_word_t * const *mit_watch_addrs = NULL;
+MIT_THREAD_LOCAL mit_uword_t mit_watch_length = 0;
+MIT_THREAD_LOCAL mit_watch_hit_t *mit_watch_hits = NULL;
+MIT_THREAD_LOCAL mit_uword_t mit_watch_hits_length = 0;
+MIT_THREAD_LOCAL mit_uword_t mit_watch_hits_count = 0;
+
+#if WATCHPOINTS
+MIT_THREAD_LOCAL volatile sig_atomic_t watch_pending = 0;
+
+// The first hit recorded since the last instruction boundary.
+static MIT_THREAD_LOCAL mit_uword_t pending_hits = 0;
+// True while the watched pages are protected.
+static MIT_THREAD_LOCAL bool armed = false;
+
+static size_t page_size;
+
+static uintptr_t page_of(const void *addr)
+{
+    return (uintptr_t)addr & ~(uintptr_t)(page_size - 1);
+}
+
+// Set the protection of every page containing a watched address.
+static void protect_pages(int prot)
+{
+    for (mit_uword_t i = 0; i < mit_watch_length; i++)
+        mprotect((void *)page_of(mit_watch_addrs[i]), page_size, prot);
+}
+
+// Test whether `addr` is in a page containing a watched address.
+static bool watched_page(const void *addr)
+{
+    for (mit_uword_t i = 0; i < mit_watch_length; i++)
+        if (page_of(mit_watch_addrs[i]) == page_of(addr))
+            return true;
+    return false;
+}
+
+// If a fault is in a watched page, record a hit if the word written is
+// watched, and allow the write to proceed by unprotecting the page, which
+// is protected again at the next instruction boundary.
+bool watch_fault(void *addr)
+{
+    if (!armed || !watched_page(addr))
+        return false;
+    mit_word_t *word = (mit_word_t *)((uintptr_t)addr & ~(uintptr_t)(sizeof(mit_word_t) - 1));
+    for (mit_uword_t i = 0; i < mit_watch_length; i++)
+        if (mit_watch_addrs[i] == word) {
+            if (mit_watch_hits_count < mit_watch_hits_length) {
+                mit_watch_hit_t *hit = &mit_watch_hits[mit_watch_hits_count];
+                hit->pc = NULL;
+                hit->addr = word;
+                hit->old_value = *word;
+                hit->new_value = *word;
+            }
+            mit_watch_hits_count++;
+            break;
+        }
+    mprotect((void *)page_of(addr), page_size, PROT_READ | PROT_WRITE);
+    watch_pending = 1;
+    return true;
+}
+
+bool watch_arm(void)
+{
+    if (!fault_install())
+        return false;
+    if (page_size == 0)
+        page_size = (size_t)sysconf(_SC_PAGESIZE);
+    pending_hits = mit_watch_hits_count;
+    armed = true;
+    protect_pages(PROT_READ);
+    return true;
+}
+
+void watch_record(mit_word_t *pc)
+{
+    mit_uword_t end = mit_watch_hits_count < mit_watch_hits_length ?
+        mit_watch_hits_count : mit_watch_hits_length;
+    for (mit_uword_t i = pending_hits; i < end; i++) {
+        mit_watch_hits[i].pc = pc;
+        mit_watch_hits[i].new_value = *mit_watch_hits[i].addr;
+    }
+    pending_hits = mit_watch_hits_count;
+    watch_pending = 0;
+    if (armed)
+        protect_pages(PROT_READ);
+}
+
+void watch_disarm(void)
+{
+    armed = false;
+    protect_pages(PROT_READ | PROT_WRITE);
+    if (watch_pending)
+        watch_record(NULL);
+}
+#endif
@@ -0,0 +1,102 @@
+# Test running an image against many inputs in a pool of processes.
+#
+# (c) Mit authors 2020
+#
+# The package is distributed under the MIT/X11 License.
+#
+# THIS PROGRAM IS PROVIDED AS IS, WITH NO WARRANTY. USE IS AT THE USER’S
+# RISK.
+
+import os
+import sys
+import tempfile
+
+from mit import *
+from mit.batch import _Worker, run_processes
+from mit.binding import run_count
+
+
+def error(message):
+    print(f"Error in batch tests: {message}")
+    sys.exit(1)
+
+# A program that writes its first argument to stdout, increments a
+# counter, and exits with the new value of the counter plus `argc`.
+VM = State(memory_words=1024)
+assembler = Assembler(VM)
+ass = assembler.instruction
+counter = VM.M.start + 0x100
+assembler.extra(ExtraInstructions.ARGV)
+assembler.push(word_bytes)
+ass(Instructions.ADD)
+ass(Instructions.LOAD)
+assembler.push(0)
+ass(Instructions.DUP)
+assembler.push(LibC.STRLEN)
+assembler.trap(LibInstructions.LIBC)
+assembler.push(LibC.STDOUT)
+assembler.trap(LibInstructions.LIBC)
+assembler.push(LibC.WRITE)
+assembler.trap(LibInstructions.LIBC)
+ass(Instructions.POP)
+assembler.pushrel(counter)
+ass(Instructions.LOAD)
+assembler.push(1)
+ass(Instructions.ADD)
+assembler.push(0)
+ass(Instructions.DUP)
+assembler.pushrel(counter)
+ass(Instructions.STORE)
+assembler.extra(ExtraInstructions.ARGC)
+ass(Instructions.ADD)
+assembler.extra(ExtraInstructions.THROW)
+VM.M_word[counter] = 5
+
+with tempfile.TemporaryDirectory() as directory:
+    object_file = os.path.join(directory, 'batch.obj')
+    VM.save(object_file, length=(counter - VM.M.start) // word_bytes + 1)
+
+    inputs = [[f'arg{i}'] + ['extra'] * (i % 3) for i in range(100)]
+    results = list(run_processes(object_file, inputs, max_workers=2, memory_words=1024))
+    if sorted(result.index for result in results) != list(range(len(inputs))):
+        error("some runs are missing")
+    for result in results:
+        args = inputs[result.index]
+        if result.args != args:
+            error(f"run {result.index} has args {result.args}; expected {args}")
+        if result.stdout != args[0].encode():
+            error(f"run {result.index} wrote {result.stdout}")
+        # Each run starts with the counter at 5.
+        exit_code = 6 + 1 + len(args)
+        if result.exit_code != exit_code:
+            error(f"run {result.index} exited with {result.exit_code}; expected {exit_code}")
+        if result.instructions is None or result.instructions != results[0].instructions:
+            error(f"run {result.index} executed {result.instructions} instructions")
+    print(f"{len(results)} runs each executed {results[0].instructions} instructions")
+
+    # Other engines do not count instructions.
+    results = list(run_processes(object_file, [['x']], run_fn='cached', memory_words=1024))
+    if results[0].instructions is not None or results[0].exit_code != 8:
+        error(f"run with 'cached' gave {results[0]}")
+
+    # Instructions are counted whether the engine is given by name or not.
+    for run_fn in ('count', run_count):
+        result = _Worker(object_file, 1024, None, run_fn).run(0, ['x'])
+        if result.instructions is None:
+            error(f"run with {run_fn!r} did not count instructions")
+
+    # Inputs are read as runs finish, so they can be endless.
+    read = 0
+    def endless_inputs():
+        global read
+        while True:
+            read += 1
+            yield ['x']
+    results = run_processes(object_file, endless_inputs(), max_workers=2, memory_words=1024)
+    next(results)
+    results.close()
+    print(f"{read} inputs read before the first result")
+    if read > 4:
+        error("too many inputs were read before the first result")
+
+print("batch tests ran OK")
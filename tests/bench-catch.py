@@ -0,0 +1,60 @@
+# Benchmark `catch` in a loop, reporting the speed of each interpreter, and
+# the speed of run_cached, which catches errors without `setjmp`, relative
+# to that of run_simple, which uses `setjmp`.
+#
+# (c) Mit authors 2020
+#
+# The package is distributed under the MIT/X11 License.
+#
+# THIS PROGRAM IS PROVIDED AS IS, WITH NO WARRANTY. USE IS AT THE USER’S
+# RISK.
+
+import time
+
+from mit.globals import *
+from mit.binding import run_cached, run_simple
+
+
+iterations = 1000000
+
+# Subroutines: return normally, and throw an error.
+goto(M.start + 0x100)
+returner = label()
+ass(RET)
+thrower = label()
+push(-1)
+extra(THROW)
+
+def bench(subroutine, run_fn):
+    '''
+    Run `catch` of `subroutine` `iterations` times with `run_fn`, and return
+    the time taken in seconds.
+    '''
+    goto(M.start)
+    push(iterations)
+    loop = label()
+    push(0)
+    push(0)
+    pushrel(subroutine)
+    extra(CATCH)
+    ass(POP)
+    push(-1)
+    ass(ADD)
+    push(0)
+    ass(DUP)
+    push(0)
+    ass(EQ)
+    pushrel(loop)
+    ass(JUMPZ)
+    ass(POP)
+    ass(RET)
+    VM.pc = M.start
+    start = time.perf_counter()
+    run(run_fn=run_fn)
+    return time.perf_counter() - start
+
+for name, subroutine in (('return', returner), ('throw', thrower)):
+    simple_elapsed = bench(subroutine, run_simple)
+    print(f"catch and {name} with run_simple: {simple_elapsed:.2f}s, {iterations / simple_elapsed:.0f} catches/s")
+    elapsed = bench(subroutine, run_cached)
+    print(f"catch and {name} with run_cached: {elapsed:.2f}s, {iterations / elapsed:.0f} catches/s, {simple_elapsed / elapsed:.2f}× run_simple")
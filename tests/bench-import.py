@@ -0,0 +1,39 @@
+# Benchmark the time taken to import the mit package and its modules.
+#
+# (c) Mit authors 2020
+#
+# The package is distributed under the MIT/X11 License.
+#
+# THIS PROGRAM IS PROVIDED AS IS, WITH NO WARRANTY. USE IS AT THE USER’S
+# RISK.
+
+import statistics
+import subprocess
+import sys
+import time
+
+
+runs = 10
+
+def bench(statement):
+    '''
+    Run `statement` in a new Python interpreter `runs` times, and return
+    the median time taken in seconds.
+    '''
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', statement], check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+baseline = bench('pass')
+print(f"Python startup: {baseline * 1000:.1f}ms")
+for statement in (
+    'import mit',
+    'import mit.binding',
+    'from mit import State',
+    'from mit.globals import *',
+):
+    elapsed = bench(statement)
+    print(f"{statement}: {(elapsed - baseline) * 1000:.1f}ms")
@@ -0,0 +1,94 @@
+# Test the stack-caching interpreter.
+#
+# (c) Mit authors 2020
+#
+# The package is distributed under the MIT/X11 License.
+#
+# THIS PROGRAM IS PROVIDED AS IS, WITH NO WARRANTY. USE IS AT THE USER’S
+# RISK.
+
+from mit.globals import *
+from mit.binding import run_cached, run_simple
+
+from mit_test import Results
+
+
+# Results are stored in consecutive words from `results.addr`.
+results = Results(assembler, M.start + 0x400)
+store_result = results.store
+
+# Subroutine: multiply two numbers.
+goto(M.start + 0x200)
+multiply = label()
+ass(MUL)
+ass(RET)
+
+# Code
+goto(M.start)
+
+# Arithmetic
+push(3)
+push(4)
+ass(ADD)
+push(5)
+ass(MUL)
+store_result(35)
+
+# Loop: sum the numbers 1 to 10.
+push(0) # Sum
+push(10) # Counter
+loop = label()
+push(0)
+ass(DUP)
+push(2)
+ass(DUP)
+ass(ADD)
+push(1)
+ass(SET)
+push(-1)
+ass(ADD)
+push(0)
+ass(DUP)
+push(0)
+ass(EQ)
+pushrel(loop)
+ass(JUMPZ)
+ass(POP)
+store_result(55)
+
+# Call a subroutine
+push(6)
+push(7)
+push(2)
+push(1)
+jumprel(multiply, CALL)
+store_result(42)
+
+# Deep stack
+for i in range(1, 7):
+    push(i)
+for i in range(5):
+    ass(ADD)
+store_result(21)
+
+# Swap
+push(1)
+push(2)
+push(0)
+ass(SWAP)
+store_result(1)
+store_result(2)
+
+# Load
+pushrel(results.addr)
+ass(LOAD)
+push(1)
+ass(ADD)
+store_result(36)
+
+ass(RET)
+
+# Test
+results.check('cached', (run_simple, run_cached), M.start)
+
+print("Cached tests ran OK")
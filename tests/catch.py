@@ -7,8 +7,11 @@
 # THIS PROGRAM IS PROVIDED AS IS, WITH NO WARRANTY. USE IS AT THE USER’S
 # RISK.
 
+import sys
+
 from mit.globals import *
 from mit.enums import MitErrorCode
+from mit.binding import run_cached
 from mit_test import *
 
 
@@ -90,3 +93,50 @@ extra(THROW)
 
 # Test
 run_test("catch", VM, correct)
+
+# Test `catch` with run_cached, which does not recurse, including an error
+# thrown from a nested `call`.
+results = M.start + 0x1000
+goto(M.start + 0x800)
+entry = label()
+push(5)
+push(1)
+push(1)
+pushrel(M.start + 0x900)
+extra(CATCH)
+pushrel(results)
+ass(STORE)
+pushrel(results + word_bytes)
+ass(STORE)
+push(0)
+push(0)
+pushrel(M.start + 0xa00)
+extra(CATCH)
+pushrel(results + 2 * word_bytes)
+ass(STORE)
+ass(RET)
+
+goto(M.start + 0x900)
+push(1)
+ass(ADD)
+ass(RET)
+
+goto(M.start + 0xa00)
+push(0)
+push(0)
+pushrel(M.start + 0xb00)
+ass(CALL)
+ass(RET)
+
+goto(M.start + 0xb00)
+push(MitErrorCode.DIVISION_BY_ZERO)
+extra(THROW)
+
+VM.pc = entry
+run(run_fn=run_cached)
+observed = [cast_to_word(M_word[results + i * word_bytes]) for i in range(3)]
+correct = [MitErrorCode.OK, 6, MitErrorCode.DIVISION_BY_ZERO]
+if observed != correct:
+    print(f"Error in catch tests with run_cached: {observed} should be {correct}")
+    sys.exit(1)
+print("Catch tests with run_cached ran OK")
@@ -11,10 +11,10 @@ import sys
 from functools import partial
 
 from mit.globals import *
-from mit.binding import stack_words_ptr
+from mit.binding import run_cached, run_super, run_verified, stack_words
 
 
-stack_words_ptr.value = 3
+stack_words.value = 3
 
 # Test results and data
 tests = [] # (name, label, error_code)
@@ -35,6 +35,25 @@ tests.append((
 ))
 ass(DUP)
 
+tests.append((
+    'Try to read from an invalid stack location in the second instruction of a pair',
+    label(),
+    MitErrorCode.INVALID_STACK_READ,
+))
+push(1)
+ass(ADD)
+
+tests.append((
+    'Try to overflow the stack in the first instruction of a pair',
+    label(),
+    MitErrorCode.STACK_OVERFLOW,
+))
+push(1)
+push(1)
+push(1)
+push(1)
+ass(ADD)
+
 tests.append((
     'Try to load from unaligned address',
     label(),
@@ -51,6 +70,7 @@ tests.append((
 UNDEFINED = 0xf7
 assert UNDEFINED not in Instructions.__members__.values(), Instructions.__members__.values()
 ass(UNDEFINED)
+code_end = assembler.pc
 
 # Tests
 success = 0
@@ -76,8 +96,15 @@ print("Running tests with State.step()")
 do_tests(partial(step, trace=True, addr=0))
 print("Running tests with run")
 do_tests(run)
+print("Running tests with run_cached")
+do_tests(partial(run, run_fn=run_cached))
+print("Running tests with run_super")
+do_tests(partial(run, run_fn=run_super))
+print("Running tests with run_verified")
+VM.verify(M.start, (code_end - M.start) // word_bytes)
+do_tests(partial(run, run_fn=run_verified))
 
-if success != 2 * len(tests):
+if success != 5 * len(tests):
     sys.exit(error)
 
 print("Errors tests ran OK")
@@ -0,0 +1,150 @@
+# Test running with an instruction budget, and resuming.
+#
+# (c) Mit authors 2020
+#
+# The package is distributed under the MIT/X11 License.
+#
+# THIS PROGRAM IS PROVIDED AS IS, WITH NO WARRANTY. USE IS AT THE USER’S
+# RISK.
+
+import sys
+from ctypes import POINTER, byref, cast
+
+from mit.globals import *
+from mit.binding import c_context, context_reset, run_fuel, stack_words
+
+
+# Subroutines
+goto(M.start + 0x200)
+# Count down the argument to 0, and return 0.
+countdown = label()
+ass(NEXT)
+countdown_loop = label()
+push(-1)
+ass(ADD)
+push(0)
+ass(DUP)
+push(0)
+ass(EQ)
+pushrel(countdown_loop)
+ass(JUMPZ)
+ass(RET)
+
+# Count down the argument to 0, then throw 42.
+countdown_throw = label()
+push(1)
+push(1)
+pushrel(countdown)
+ass(CALL)
+ass(POP)
+push(42)
+extra(THROW)
+
+# Main programs, which store a result at the address on top of the stack.
+goto(M.start)
+# Call `countdown` and store 7.
+call_countdown = label()
+push(20)
+push(1)
+push(1)
+pushrel(countdown)
+ass(CALL)
+push(7)
+ass(ADD)
+push(0)
+ass(SWAP)
+ass(STORE)
+ass(RET)
+
+# Catch the error thrown by `countdown_throw` and store it.
+catch_countdown = label()
+push(20)
+push(1)
+push(0)
+pushrel(countdown_throw)
+extra(CATCH)
+push(0)
+ass(SWAP)
+ass(STORE)
+ass(RET)
+
+# Results
+results = M.start + 0x400
+
+def make_context(pc, result):
+    stack = (c_word * stack_words.value)()
+    stack[0] = result
+    return c_context(
+        pc=cast(pc, POINTER(c_word)),
+        ir=0,
+        stack=stack,
+        stack_words=stack_words.value,
+        stack_depth=1,
+        frames=None,
+    )
+
+def run_sliced(contexts, fuel):
+    '''
+    Run `contexts` in turn for at most `fuel` words each, until they have
+    all finished. Returns the number of times a run ran out of fuel inside
+    a call.
+    '''
+    suspended_in_call = 0
+    running = list(contexts)
+    while len(running) > 0:
+        for ctx in list(running):
+            remaining = c_uword(fuel)
+            error = run_fuel(byref(ctx), byref(remaining))
+            if error == MitErrorCode.OUT_OF_FUEL:
+                assert remaining.value == 0
+                if ctx.frames is not None:
+                    suspended_in_call += 1
+            else:
+                assert error == MitErrorCode.OK, error
+                assert ctx.stack_depth == 0
+                running.remove(ctx)
+    return suspended_in_call
+
+failures = 0
+def check(name, observed, correct):
+    global failures
+    print(f'{name}: {observed}')
+    if observed != correct:
+        print(f'Error in fuel tests: {name} should be {correct}')
+        failures += 1
+
+# Run with enough fuel.
+ctx = make_context(call_countdown, results)
+remaining = c_uword(1000)
+check('Result with enough fuel', run_fuel(byref(ctx), byref(remaining)), MitErrorCode.OK)
+check('Stored value', M_word[results], 7)
+words_run = 1000 - remaining.value
+
+# Run with exactly enough fuel, and with too little.
+ctx = make_context(call_countdown, results)
+remaining = c_uword(words_run)
+check('Result with exactly enough fuel', run_fuel(byref(ctx), byref(remaining)), MitErrorCode.OK)
+ctx = make_context(call_countdown, results)
+remaining = c_uword(words_run - 1)
+check('Result with too little fuel', run_fuel(byref(ctx), byref(remaining)), MitErrorCode.OUT_OF_FUEL)
+context_reset(byref(ctx))
+check('Frames after reset', ctx.frames, None)
+
+# Interleave several runs, in small slices.
+for i in range(4):
+    M_word[results + i * word_bytes] = 0
+contexts = [
+    make_context(
+        call_countdown if i % 2 == 0 else catch_countdown,
+        results + i * word_bytes,
+    )
+    for i in range(4)
+]
+suspended_in_call = run_sliced(contexts, 3)
+check('Suspended in a call', suspended_in_call > 0, True)
+check('Interleaved results', [M_word[results + i * word_bytes] for i in range(4)], [7, 42, 7, 42])
+
+if failures != 0:
+    sys.exit(1)
+
+print("Fuel tests ran OK")
@@ -0,0 +1,128 @@
+# Test the interpreter that uses guard pages to check the stack.
+#
+# (c) Mit authors 2020
+#
+# The package is distributed under the MIT/X11 License.
+#
+# THIS PROGRAM IS PROVIDED AS IS, WITH NO WARRANTY. USE IS AT THE USER’S
+# RISK.
+
+import sys
+
+from mit.globals import *
+from mit.binding import run_guarded, run_simple, stack_words
+
+from mit_test import Results
+
+
+# The result of each test is stored at `result`.
+result = M.start + 0x400
+
+# Subroutines
+goto(M.start + 0x200)
+# Add 1 to the argument.
+increment = label()
+push(1)
+ass(ADD)
+ass(RET)
+# Push forever.
+push_forever = label()
+push(1)
+pushrel(push_forever)
+ass(JUMP)
+# Pop from an empty stack.
+pop_empty = label()
+ass(POP)
+ass(RET)
+
+# Test results and data
+tests = [] # (name, label, error_code, Results)
+def add_test(name, error_code):
+    '''
+    Start a test at the current address, and return its Results, which
+    are only checked if `error_code` is `MitErrorCode.OK`.
+    '''
+    results = Results(assembler, result)
+    tests.append((name, label(), error_code, results))
+    return results
+
+goto(M.start)
+results = add_test('Compute a result', MitErrorCode.OK)
+push(41)
+push(1)
+push(1)
+pushrel(increment)
+ass(CALL)
+push(1)
+ass(ADD)
+results.store(43)
+ass(RET)
+
+add_test('Read from an empty stack', MitErrorCode.INVALID_STACK_READ)
+ass(ADD)
+ass(RET)
+
+add_test('Pop from an empty stack', MitErrorCode.INVALID_STACK_READ)
+ass(POP)
+ass(RET)
+
+add_test('Overflow the stack', MitErrorCode.STACK_OVERFLOW)
+pushrel(push_forever)
+ass(JUMP)
+
+add_test('Return with too many items on the stack', MitErrorCode.STACK_OVERFLOW)
+for i in range(stack_words.value + 1):
+    push(i)
+ass(RET)
+
+results = add_test('Catch a stack overflow', MitErrorCode.OK)
+push(0)
+push(0)
+pushrel(push_forever)
+extra(CATCH)
+results.store(MitErrorCode.STACK_OVERFLOW)
+ass(RET)
+
+results = add_test('Catch a pop from an empty stack', MitErrorCode.OK)
+push(0)
+push(0)
+pushrel(pop_empty)
+extra(CATCH)
+results.store(MitErrorCode.INVALID_STACK_READ)
+ass(RET)
+
+add_test('Throw with items on the stack', 42)
+push(1)
+push(2)
+push(42)
+extra(THROW)
+
+# Tests
+def run_test(run_fn, pc, results):
+    '''
+    Run a test with an empty stack, and return the error, the results if
+    there was no error, and the stack.
+    '''
+    VM.context.stack_depth = 0
+    try:
+        observed = MitErrorCode.OK, results.run(run_fn, pc)
+    except VMError as e:
+        observed = e.args[0], None
+    return observed + (VM.stack.tolist(),)
+
+failures = 0
+for name, pc, error, results in tests:
+    print(f'Test "{name}"')
+    correct = (error, results.correct if error == MitErrorCode.OK else None)
+    # The stack is left as `run_simple` leaves it.
+    correct += (run_test(run_simple, pc, results)[2],)
+    for run_fn in (run_simple, run_guarded):
+        observed = run_test(run_fn, pc, results)
+        if observed != correct:
+            print(f"Error in guarded tests: result is {observed}; should be {correct}")
+            failures += 1
+
+if failures != 0:
+    sys.exit(1)
+
+print("Guarded tests ran OK")
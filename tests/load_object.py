@@ -81,6 +81,60 @@ if res != error_code:
     sys.exit(1)
 
 
+# Test loading a file of several pages, which is mapped where possible.
+def load_pages_test(addr, obj):
+    '''
+    Write `obj` to a file, load it at `addr`, and check that it was loaded
+    without changing the memory around it, and that writing the memory does
+    not change the file.
+    '''
+    M.fill(0xaa)
+    # Replace the file, as it may be mapped.
+    if os.path.exists(test_file_name):
+        os.remove(test_file_name)
+    with open(test_file_name, 'wb') as h: h.write(obj)
+    length = load(test_file_name, addr)
+    data = bytes(obj[obj.index(b'\n') + 1:] if obj[:2] == b'#!' else obj)
+    if length != len(data) // word_bytes:
+        print(f'Error in State.load() test "{test}": length is {length}')
+        sys.exit(1)
+    loaded = bytes(M.read_bytes(addr, len(data)))
+    before = bytes(M.read_bytes(M.start, addr - M.start))
+    after = bytes(M.read_bytes(addr + len(data), 16))
+    if loaded != data or before != b'\xaa' * len(before) or after != b'\xaa' * 16:
+        print(f'Error in State.load() test "{test}": memory is wrong')
+        sys.exit(1)
+    M.fill(0, addr, addr + len(data))
+    with open(test_file_name, 'rb') as h:
+        if h.read() != obj:
+            print(f'Error in State.load() test "{test}": file was changed')
+            sys.exit(1)
+
+pages = bytes(range(256)) * word_bytes * 64
+test = 'Load pages'
+load_pages_test(M.start, pages)
+test = 'Load pages at unaligned address'
+load_pages_test(M.start + word_bytes * 3, pages)
+test = 'Load pages with #! line'
+load_pages_test(M.start + word_bytes * 2, b'#!/usr/bin/mit\n' + pages)
+
+
+# Test saving over a loaded file, which must not change the memory it was
+# loaded into.
+test = 'Save over loaded file'
+os.remove(test_file_name)
+with open(test_file_name, 'wb') as h: h.write(pages)
+load(test_file_name)
+save(test_file_name, length=16)
+if bytes(M.read_bytes(M.start, len(pages))) != pages:
+    print(f'Error in State.load() test "{test}": memory was changed')
+    sys.exit(1)
+with open(test_file_name, 'rb') as h:
+    if h.read() != pages[:16 * word_bytes]:
+        print(f'Error in State.load() test "{test}": file is wrong')
+        sys.exit(1)
+
+
 # Remove test file
 os.remove(test_file_name)
 
@@ -0,0 +1,116 @@
+# Test the memory backends of State.
+#
+# (c) Mit authors 2020
+#
+# The package is distributed under the MIT/X11 License.
+#
+# THIS PROGRAM IS PROVIDED AS IS, WITH NO WARRANTY. USE IS AT THE USER’S
+# RISK.
+
+import os
+import sys
+from multiprocessing import shared_memory
+
+from mit import *
+from mit.memory import file_mapping
+
+
+failures = 0
+def check(name, observed, correct):
+    global failures
+    print(f'{name}: {observed}')
+    if observed != correct:
+        print(f'Error in memory backend tests: {name} should be {correct}')
+        failures += 1
+
+def assemble_store(state, value, addr):
+    '''
+    Assemble code at the start of `state.M` that stores `value` at `addr`.
+    '''
+    assembler = Assembler(state)
+    assembler.push(value)
+    assembler.push(addr)
+    assembler.instruction(Instructions.STORE)
+    assembler.instruction(Instructions.RET)
+
+test_file_name = 'test-memory.obj'
+words = 1024
+
+# A private file mapping does not change the file.
+with open(test_file_name, 'wb') as h:
+    h.write(bytes(words * word_bytes))
+state = State(memory=file_mapping(test_file_name))
+check('Length of private mapping', len(state.M_word), words)
+assemble_store(state, 42, state.M.start + 0x100)
+state.run()
+check('Stored value', state.M_word[state.M.start + 0x100], 42)
+with open(test_file_name, 'rb') as h:
+    check('File after private run', h.read() == bytes(words * word_bytes), True)
+
+# A shared file mapping does.
+state = State(memory=file_mapping(test_file_name, shared=True))
+assemble_store(state, 42, state.M.start + 0x100)
+state.run()
+with open(test_file_name, 'rb') as h:
+    data = h.read()
+check('File after shared run', int.from_bytes(data[0x100:0x100 + word_bytes], sys.byteorder), 42)
+
+# A file, with or without a #! line, can be mapped privately into a larger
+# memory.
+image = bytes(range(256)) * word_bytes * 4
+for header in (b'', b'#!/usr/bin/mit\n'):
+    with open(test_file_name, 'wb') as h:
+        h.write(header + image)
+    state = State(memory=file_mapping(test_file_name, memory_words=words * 4))
+    check(f'Length of larger mapping with header {header}', len(state.M_word), words * 4)
+    check('Mapped image', bytes(state.M.read_bytes(state.M.start, len(image))) == image, True)
+    check('Memory beyond image', bytes(state.M.read_bytes(state.M.start + len(image), len(image))) == bytes(len(image)), True)
+    state.M.fill(0)
+    with open(test_file_name, 'rb') as h:
+        check('File after writing larger mapping', h.read() == header + image, True)
+# It cannot be mapped shared, nor into a smaller memory.
+for name, kwargs in (
+        ('Shared mapping of file with #! line rejected', {'shared': True}),
+        ('Mapping smaller than file rejected', {'memory_words': words // 2}),
+):
+    try:
+        file_mapping(test_file_name, **kwargs)
+        check(name, False, True)
+    except Error:
+        check(name, True, True)
+os.remove(test_file_name)
+
+# States using the same shared memory segment see each other's writes.
+shm = shared_memory.SharedMemory(create=True, size=words * word_bytes)
+other = shared_memory.SharedMemory(name=shm.name)
+try:
+    state = State(memory=shm.buf)
+    other_state = State(memory=other.buf)
+    # Loading a file writes it to the segment.
+    image = bytearray(words * word_bytes)
+    image[0x200:0x200 + word_bytes] = (44).to_bytes(word_bytes, sys.byteorder)
+    with open(test_file_name, 'wb') as h:
+        h.write(image)
+    state.load(test_file_name)
+    os.remove(test_file_name)
+    check('Loaded value seen through other mapping', other_state.M_word[other_state.M.start + 0x200], 44)
+    assemble_store(state, 43, state.M.start + 0x100)
+    state.run()
+    check('Value seen through other mapping', other_state.M_word[other_state.M.start + 0x100], 43)
+finally:
+    del state, other_state
+    other.close()
+    shm.close()
+    shm.unlink()
+
+# Memory that is not a whole number of words is rejected.
+try:
+    State(memory=bytearray(word_bytes + 1))
+    check('Memory of odd length rejected', False, True)
+except Error:
+    pass
+
+if failures != 0:
+    sys.exit(1)
+
+print("Memory backend tests ran OK")
@@ -0,0 +1,63 @@
+# Test the bulk operations of Memory.
+#
+# (c) Mit authors 2020
+#
+# The package is distributed under the MIT/X11 License.
+#
+# THIS PROGRAM IS PROVIDED AS IS, WITH NO WARRANTY. USE IS AT THE USER’S
+# RISK.
+
+import io
+import sys
+
+from mit.globals import *
+
+
+failures = 0
+def check(name, observed, correct):
+    global failures
+    print(f'{name}: {observed}')
+    if observed != correct:
+        print(f'Error in bulk memory tests: {name} should be {correct}')
+        failures += 1
+
+base = M.start + 0x100
+
+# Words
+M_word.write_words(base, [1, 2, -1, 4])
+check('read_words', M_word.read_words(base, 4).tolist(), [1, 2, uword_max, 4])
+check('read_words signed', M_word.read_words(base, 4, signed=True).tolist(), [1, 2, -1, 4])
+check('Single word', M_word[base + word_bytes], 2)
+M_word.write_words(base, M_word.read_words(base + 2 * word_bytes, 2))
+check('write_words from buffer', M_word.read_words(base, 4, signed=True).tolist(), [-1, 4, -1, 4])
+
+# Views share memory.
+words = M_word.cast(word_bytes, signed=True)
+words[(base - M.start) // word_bytes] = 5
+check('cast', M_word[base], 5)
+check('read_bytes', M.read_bytes(base, 1).tolist(), [5 if sys.byteorder == 'little' else 0])
+
+# fill and find
+M.fill(0, base, base + 0x100)
+M.fill(0xaa, base + 3, base + 7)
+check('Byte fill', M.read_bytes(base, 8).tolist(), [0, 0, 0, 0xaa, 0xaa, 0xaa, 0xaa, 0])
+check('Byte find', M.find(0xaa, base), base + 3)
+check('Byte find not found', M.find(0xbb, base, base + 0x100), None)
+M_word.fill(-2, base + 2 * word_bytes, base + 4 * word_bytes)
+check('Word fill', M_word.read_words(base + 2 * word_bytes, 3, signed=True).tolist(), [-2, -2, 0])
+check('Word find', M_word.find(-2, base), base + 2 * word_bytes)
+# A matching sequence of bytes that is not aligned is not found.
+M.fill(0, base, base + 0x100)
+M.fill(0xff, base + 1, base + 1 + word_bytes)
+check('Unaligned word not found', M_word.find(-1, base, base + 0x100), None)
+
+# dump
+M.fill(ord('a'), base, base + 16)
+out = io.StringIO()
+VM.dump(base, 2, file=out)
+check('dump', out.getvalue().split('  ', 1)[1], ' '.join(['61'] * 8) + '  ' + ' '.join(['61'] * 8) + '  |' + 'a' * 16 + '|\n')
+
+if failures != 0:
+    sys.exit(1)
+
+print("Bulk memory tests ran OK")
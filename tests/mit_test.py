@@ -9,8 +9,8 @@
 
 import sys
 
-from mit.enums import MitErrorCode
-from mit.binding import uword_max, sign_bit
+from mit.enums import Instructions, MitErrorCode
+from mit.binding import sign_bit, sign_extend, uword_max, word_bytes
 
 
 def cast_to_word(n):
@@ -45,3 +45,51 @@ def run_test(name, state, correct):
             return MitErrorCode.BREAK
     state.step(trace=True, addr=0, step_callback=test_callback)
     print(f"{name.capitalize()} tests ran OK")
+
+class Results:
+    '''
+    Results stored in consecutive words of memory by test code, to compare
+    the results of running the code with different `run_fn`s.
+
+     - assembler - Assembler - the assembler of the test code.
+     - addr - int - the address of the first result.
+     - correct - list of int - the correct value of each result.
+    '''
+    def __init__(self, assembler, addr):
+        self.assembler = assembler
+        self.addr = addr
+        self.correct = []
+
+    def store(self, value):
+        '''
+        Assemble code to store the top of the stack as the next result,
+        whose correct value is `value`.
+        '''
+        self.assembler.pushrel(self.addr + len(self.correct) * word_bytes)
+        self.assembler.instruction(Instructions.STORE)
+        self.correct.append(value)
+
+    def run(self, run_fn, pc):
+        '''
+        Run the code from `pc` with `run_fn`, and return the results.
+        '''
+        M_word = self.assembler.state.M_word
+        addrs = [self.addr + i * word_bytes for i in range(len(self.correct))]
+        for addr in addrs:
+            M_word[addr] = 0
+        self.assembler.state.pc = pc
+        self.assembler.state.run(run_fn=run_fn)
+        return [sign_extend(M_word[addr]) for addr in addrs]
+
+    def check(self, name, run_fns, pc):
+        '''
+        Run the code from `pc` with each of `run_fns`, and exit with an
+        error if the results are not correct.
+        '''
+        for run_fn in run_fns:
+            observed = self.run(run_fn, pc)
+            print(f"Results: {observed}")
+            print(f"Correct: {self.correct}")
+            if observed != self.correct:
+                print(f"Error in {name} tests")
+                sys.exit(1)
@@ -0,0 +1,133 @@
+# Test deep recursion with `call` and `catch` and a large stack size.
+#
+# (c) Mit authors 2020
+#
+# The package is distributed under the MIT/X11 License.
+#
+# THIS PROGRAM IS PROVIDED AS IS, WITH NO WARRANTY. USE IS AT THE USER’S
+# RISK.
+
+import sys
+
+from mit.globals import *
+from mit.enums import MitErrorCode
+from mit.binding import (
+    VMError, max_call_depth, run_cached, run_simple, stack_words
+)
+
+
+# Each frame has room for a million words, so allocating a whole frame per
+# call would need far more memory than a recursion depth of 1000 uses.
+stack_words.value = 0x100000
+depth = 1000
+result = M.start + 0x400
+
+# Subroutine: sum the numbers from 1 to n recursively.
+goto(M.start + 0x100)
+base_case = M.start + 0x200
+sum_to = label()
+push(0)
+ass(DUP)
+pushrel(base_case)
+ass(JUMPZ)
+push(0)
+ass(DUP)
+push(-1)
+ass(ADD)
+push(1)
+push(1)
+jumprel(sum_to, CALL)
+ass(ADD)
+ass(RET)
+goto(base_case)
+ass(RET)
+
+# Subroutine: like sum_to, but recurse with `catch`.
+goto(M.start + 0x280)
+catch_base_case = M.start + 0x380
+catch_sum_to = label()
+push(0)
+ass(DUP)
+pushrel(catch_base_case)
+ass(JUMPZ)
+push(0)
+ass(DUP)
+push(-1)
+ass(ADD)
+push(1)
+push(1)
+pushrel(catch_sum_to)
+extra(CATCH)
+ass(POP) # Error code
+ass(ADD)
+ass(RET)
+goto(catch_base_case)
+ass(RET)
+
+def run_test(subroutine, run_fn, depth):
+    M_word[result] = 0
+    goto(M.start)
+    push(depth)
+    push(1)
+    push(1)
+    jumprel(subroutine, CALL)
+    pushrel(result)
+    ass(STORE)
+    ass(RET)
+    VM.pc = M.start
+    run(run_fn=run_fn)
+    return M_word[result]
+
+def peak_memory():
+    '''
+    Return the peak virtual memory size of the process in bytes, or `None`
+    if it is not known.
+    '''
+    try:
+        with open('/proc/self/status') as h:
+            for line in h:
+                if line.startswith('VmPeak:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def check(name, subroutine, run_fn, depth):
+    correct = depth * (depth + 1) // 2
+    observed = run_test(subroutine, run_fn, depth)
+    print(f"Result with {name} to depth {depth}: {observed}; correct: {correct}")
+    if observed != correct:
+        print("Error in recursion tests")
+        sys.exit(1)
+
+old_peak = peak_memory()
+for name, subroutine in (('call', sum_to), ('catch', catch_sum_to)):
+    for run_fn in (run_simple, run_cached):
+        check(name, subroutine, run_fn, depth)
+peak = peak_memory()
+if peak is not None:
+    # Allow a few frames' worth of memory, but not one per call.
+    limit = 4 * stack_words.value * word_bytes
+    print(f"Peak memory grew by {peak - old_peak} bytes; limit {limit}")
+    if peak - old_peak > limit:
+        print("Error in recursion tests: frames use too much memory")
+        sys.exit(1)
+
+# run_cached does not use C recursion for `call`, so can go much deeper.
+stack_words.value = 32
+check('call', sum_to, run_cached, 100000)
+
+# Exceed the call depth limit.
+max_call_depth.value = 100
+try:
+    run_test(sum_to, run_cached, 1000)
+    print("Error in recursion tests: call depth limit not enforced")
+    sys.exit(1)
+except VMError as e:
+    print(f"Call depth limit gave error {e}")
+    if e.args[0] != MitErrorCode.STACK_OVERFLOW:
+        print("Error in recursion tests")
+        sys.exit(1)
+check('call', sum_to, run_cached, 99)
+
+print("Recursion tests ran OK")
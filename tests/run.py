@@ -28,4 +28,52 @@ except VMError as e:
         print(f"Error in run() tests: error code {e.args[0]} returned; expected {error_code}")
         sys.exit(1)
 
+# The stack is left as it was when execution halted.
+def check_stack(name, correct):
+    observed = VM.stack.tolist()
+    print(f"{name}: {observed}")
+    if observed != correct:
+        print(f"Error in run() tests: stack should be {correct}")
+        sys.exit(1)
+
+check_stack('Stack after throw', [])
+goto(M.start + 0x100)
+code = label()
+push(1)
+push(2)
+ass(RET)
+VM.pc = code
+run()
+check_stack('Stack after run', [1, 2])
+
+# Run again, keeping the stack.
+run(keep_stack=True)
+check_stack('Stack after run with stack kept', [1, 2, 1, 2])
+VM.stack[0] = 3
+check_stack('Stack after assignment', [3, 2, 1, 2])
+
+# Run again with an empty stack.
+run()
+check_stack('Stack after run with new stack', [1, 2])
+
+# Select run functions by name.
+from mit.binding import profile_labels, profile_reset, run_fns
+for name in run_fns:
+    if name == 'profile':
+        profile_reset()
+    run(run_fn=name)
+    check_stack(f'Stack after run with {name}', [1, 2])
+if 'profile' in run_fns:
+    labels = profile_labels()
+    print(f"Profile labels: {len(labels)}")
+    if sum(label['correct_count'] + label['wrong_count'] for label in labels) == 0:
+        print("Error in run() tests: profile is empty")
+        sys.exit(1)
+try:
+    run(run_fn='no_such_run_fn')
+    print("Error in run() tests: run() accepted an unknown run function")
+    sys.exit(1)
+except Error:
+    pass
+
 print("run() tests ran OK")
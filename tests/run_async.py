@@ -0,0 +1,136 @@
+# Test run_async(), and interrupting runs.
+#
+# (c) Mit authors 2020
+#
+# The package is distributed under the MIT/X11 License.
+#
+# THIS PROGRAM IS PROVIDED AS IS, WITH NO WARRANTY. USE IS AT THE USER’S
+# RISK.
+
+import asyncio
+import sys
+from ctypes import POINTER, byref, c_void_p, cast
+
+from mit import *
+from mit.binding import run_fuel
+
+
+def error(message):
+    print(f"Error in run_async() tests: {message}")
+    sys.exit(1)
+
+def make_state():
+    '''
+    Make a State with three programs:
+     - finish - push 42 and return.
+     - forever - loop forever.
+     - call_forever - call a subroutine that loops forever.
+    Returns the State, the addresses of the programs, and the range of
+    addresses of the loop.
+    '''
+    VM = State(memory_words=4096)
+    assembler = Assembler(VM)
+    ass = assembler.instruction
+    loop_start = assembler.label()
+    assembler.pushrel(loop_start)
+    ass(Instructions.JUMP)
+    loop_end = assembler.label()
+    finish = assembler.label()
+    assembler.push(42)
+    ass(Instructions.RET)
+    forever = assembler.label()
+    assembler.pushrel(loop_start)
+    ass(Instructions.JUMP)
+    call_forever = assembler.label()
+    assembler.push(7)
+    assembler.push(0)
+    assembler.push(0)
+    assembler.pushrel(loop_start)
+    ass(Instructions.CALL)
+    ass(Instructions.RET)
+    return VM, finish, forever, call_forever, range(loop_start, loop_end + 1)
+
+async def main():
+    VM, finish, forever, call_forever, loop = make_state()
+
+    # A run that finishes.
+    VM.pc = finish
+    await VM.run_async()
+    print(f"Stack after run_async: {VM.stack.tolist()}")
+    if VM.stack.tolist() != [42]:
+        error("stack should be [42]")
+
+    # A run that times out.
+    VM.pc = forever
+    try:
+        await VM.run_async(timeout=0.1)
+        error("run_async() did not time out")
+    except asyncio.TimeoutError:
+        pass
+    print(f"Stopped after timeout at pc={VM.pc:#x}")
+    if VM.pc not in loop:
+        error("pc should be in the loop")
+
+    # A run interrupted inside a call, after which the State can be reused.
+    VM.pc = call_forever
+    try:
+        await VM.run_async(timeout=0.1)
+        error("run_async() did not time out")
+    except asyncio.TimeoutError:
+        pass
+    print(f"Stopped inside call at pc={VM.pc:#x}")
+    if VM.pc not in loop:
+        error("pc should be in the loop")
+    if VM.context.frames is not None:
+        error("the frames of the interrupted run were not discarded")
+    VM.pc = finish
+    await VM.run_async()
+    if VM.stack.tolist() != [42]:
+        error("stack should be [42] after reuse")
+
+    # Cancel several concurrent runs.
+    states = [make_state() for _ in range(4)]
+    tasks = []
+    for state, _, forever, _, _ in states:
+        state.pc = forever
+        tasks.append(asyncio.ensure_future(state.run_async()))
+    await asyncio.sleep(0.1)
+    for task in tasks:
+        task.cancel()
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    for (state, _, _, _, loop), result in zip(states, results):
+        if not isinstance(result, asyncio.CancelledError):
+            error(f"cancelled run returned {result!r}")
+        if state.pc not in loop:
+            error("pc should be in the loop after cancellation")
+    print(f"Cancelled {len(tasks)} concurrent runs")
+
+    # Errors are raised as usual.
+    assembler = Assembler(VM, pc=VM.M.start + 0x100)
+    VM.pc = assembler.label()
+    assembler.push(-3)
+    assembler.extra(ExtraInstructions.THROW)
+    try:
+        await VM.run_async()
+        error("run_async() did not raise an error")
+    except VMError as e:
+        if e.args[0] != -3:
+            error(f"error code {e.args[0]} returned; expected -3")
+
+asyncio.run(main())
+
+# `run_fuel` returns `MIT_ERROR_INTERRUPTED` without running anything if
+# the flag is already set, and keeps the remaining fuel.
+VM, finish, _, _, _ = make_state()
+VM.pc = finish
+VM.run() # Allocate the stack.
+VM.context.pc = cast(finish, POINTER(c_word))
+VM.context.stack_depth = 0
+VM.context.interrupt = 1
+fuel = c_uword(10)
+result = run_fuel(byref(VM.context), byref(fuel))
+pc = cast(VM.context.pc, c_void_p).value
+if result != MitErrorCode.INTERRUPTED or fuel.value != 10 or pc != finish:
+    error(f"run_fuel returned {result} with fuel {fuel.value}, pc={pc:#x}")
+
+print("run_async() tests ran OK")
@@ -0,0 +1,103 @@
+# Test State.snapshot() and State.restore().
+#
+# (c) Mit authors 2020
+#
+# The package is distributed under the MIT/X11 License.
+#
+# THIS PROGRAM IS PROVIDED AS IS, WITH NO WARRANTY. USE IS AT THE USER’S
+# RISK.
+
+import mmap
+import sys
+
+from mit.globals import *
+from mit.snapshot import DirtyTracker, running
+
+
+failures = 0
+def check(name, observed, correct):
+    global failures
+    print(f'{name}: {observed}')
+    if observed != correct:
+        print(f'Error in snapshot tests: {name} should be {correct}')
+        failures += 1
+
+# Code that increments a counter, and leaves its new value on the stack.
+counter = M.start + 3 * mmap.PAGESIZE
+goto(M.start)
+code = label()
+pushrel(counter)
+ass(LOAD)
+push(1)
+ass(ADD)
+push(0)
+ass(DUP)
+pushrel(counter)
+ass(STORE)
+ass(RET)
+
+M_word[counter] = 10
+VM.pc = code
+run()
+check('Stack before snapshot', VM.stack.tolist(), [11])
+snapshot = VM.snapshot()
+
+# Run some more, and write far away.
+for i in range(3):
+    VM.pc = code
+    run(keep_stack=True)
+M_word[M.end - word_bytes] = 99
+check('Stack after runs', VM.stack.tolist(), [11, 12, 13, 14])
+VM.pc = M.start + word_bytes
+
+# Restore: only the pages written are copied.
+check('Pages copied', VM.restore(snapshot), 2)
+check('Counter after restore', M_word[counter], 11)
+check('Far word after restore', M_word[M.end - word_bytes], 0)
+check('Stack after restore', VM.stack.tolist(), [11])
+check('pc after restore', VM.pc, code)
+
+# Restore again, without changes.
+check('Pages copied without changes', VM.restore(snapshot), 0)
+
+# Restore an earlier snapshot after taking a later one.
+later = VM.snapshot()
+M_word[counter] = 0
+VM.restore(snapshot)
+M_word[counter] = 50
+check('Pages copied from other snapshot', VM.restore(later), 1)
+check('Counter after restoring other snapshot', M_word[counter], 11)
+
+# Restore a snapshot into a State that has not made one.
+other = State(memory_words=len(M_word))
+other.restore(snapshot)
+check('Counter in other State', other.M_word[other.M.start + (counter - M.start)], 11)
+check('pc in other State', other.pc - other.M.start, code - M.start)
+
+# A write to a State that is missed by its tracker, because another State
+# is running when another tracker clears the soft-dirty bits, is restored.
+VM.restore(snapshot)
+clear_refs = DirtyTracker._clear_refs
+def write_and_clear_refs():
+    M_word[counter] = 77
+    clear_refs()
+DirtyTracker._clear_refs = staticmethod(write_and_clear_refs)
+try:
+    with running():
+        other.snapshot()
+finally:
+    DirtyTracker._clear_refs = staticmethod(clear_refs)
+VM.restore(snapshot)
+check('Counter after restoring missed write', M_word[counter], 11)
+
+# A snapshot of a different size of memory is rejected.
+try:
+    State(memory_words=len(M_word) * 2).restore(snapshot)
+    check('Snapshot of different size rejected', False, True)
+except Error:
+    pass
+
+if failures != 0:
+    sys.exit(1)
+
+print("Snapshot tests ran OK")
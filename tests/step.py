@@ -7,7 +7,9 @@
 # THIS PROGRAM IS PROVIDED AS IS, WITH NO WARRANTY. USE IS AT THE USER’S
 # RISK.
 
+import io
 import sys
+from contextlib import redirect_stdout
 
 from mit.globals import *
 
@@ -30,4 +32,55 @@ if VM.pc != final_pc:
     print(f"Error in step() tests: pc = {VM.pc - M.start:#x}")
     sys.exit(1)
 
+# Run to an address, and to the first of several addresses.
+def check_pc(name, correct):
+    print(f"{name}: pc = {VM.pc - M.start:#x}")
+    if VM.pc != correct:
+        print(f"Error in step() tests: pc should be {correct - M.start:#x}")
+        sys.exit(1)
+
+VM.pc = M.start
+step(addr=M.start + 6 * word_bytes)
+check_pc('Run to address', M.start + 6 * word_bytes)
+VM.pc = M.start
+step(addr=[M.start + 8 * word_bytes, M.start + 3 * word_bytes])
+check_pc('Run to addresses', M.start + 3 * word_bytes)
+
+# Run for a number of steps, calling `final_callback` when they are done.
+done = []
+VM.pc = M.start
+step(n=5, final_callback=lambda handler, stack: done.append(handler.done))
+check_pc('Run 5 steps', M.start + 5 * word_bytes)
+if done != [5]:
+    print(f"Error in step() tests: done = {done}")
+    sys.exit(1)
+
+# Report the steps run before an error, both when the exit condition is
+# tested natively and when `break_fn` is called before each instruction.
+error_code = M.start + 0x100
+goto(error_code)
+push(1)
+push(2)
+ass(POP)
+ass(POP)
+ass(POP)
+
+def step_to_error(step_callback):
+    VM.pc = error_code
+    output = io.StringIO()
+    with redirect_stdout(output):
+        try:
+            step(n=100, step_callback=step_callback)
+        except VMError:
+            pass
+    return output.getvalue(), VM.pc
+
+native = step_to_error(None)
+print(f"Native: {native}")
+callback = step_to_error(lambda handler, stack: None)
+print(f"Callback: {callback}")
+if native != callback or 'after 0 steps' in native[0]:
+    print("Error in step() tests: steps before an error are wrong")
+    sys.exit(1)
+
 print("step() tests ran OK")
@@ -0,0 +1,66 @@
+# Test the superinstruction interpreter.
+#
+# (c) Mit authors 2020
+#
+# The package is distributed under the MIT/X11 License.
+#
+# THIS PROGRAM IS PROVIDED AS IS, WITH NO WARRANTY. USE IS AT THE USER’S
+# RISK.
+
+from mit.globals import *
+from mit.binding import run_simple, run_super
+
+from mit_test import Results
+
+
+# Results are stored in consecutive words from `results.addr`.
+results = Results(assembler, M.start + 0x400)
+store_result = results.store
+
+# Data
+data = M.start + 0x300
+M[data] = 42
+
+# Code
+goto(M.start)
+
+# Increment repeatedly, giving runs of several different lengths.
+push(0)
+for i in range(20):
+    push(1)
+    ass(ADD)
+store_result(20)
+
+# Decrement repeatedly.
+push(30)
+for i in range(5):
+    push(1)
+    ass(NEG)
+    ass(ADD)
+store_result(25)
+
+# Mixed sequences.
+push(7)
+push(1)
+ass(NEG)
+ass(ADD)
+push(1)
+ass(ADD)
+push(2)
+ass(NEG)
+ass(ADD)
+store_result(5)
+
+# Load a byte and increment it.
+pushrel(data)
+ass(LOAD1)
+push(1)
+ass(ADD)
+store_result(43)
+
+ass(RET)
+
+# Test
+results.check('superinstruction', (run_simple, run_super), M.start)
+
+print("Superinstruction tests ran OK")
@@ -0,0 +1,182 @@
+# Test running States concurrently in threads.
+#
+# (c) Mit authors 2020
+#
+# The package is distributed under the MIT/X11 License.
+#
+# THIS PROGRAM IS PROVIDED AS IS, WITH NO WARRANTY. USE IS AT THE USER’S
+# RISK.
+
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from ctypes import addressof
+
+from mit import *
+from mit.batch import run_threads
+from mit.binding import (
+    run_break, run_ptr, run_simple, stack_words, thread_local
+)
+
+
+def error(message):
+    print(f"Error in threads tests: {message}")
+    sys.exit(1)
+
+def make_state(n, marker, pushes=0, **kwargs):
+    '''
+    Make a State that counts down from `n`, pushes `pushes` 1s and then
+    `marker`, and returns.
+    '''
+    state = State(memory_words=1024, **kwargs)
+    assembler = Assembler(state)
+    ass = assembler.instruction
+    assembler.push(n)
+    loop = assembler.label()
+    assembler.push(-1)
+    ass(Instructions.ADD)
+    assembler.push(0)
+    ass(Instructions.DUP)
+    assembler.push(0)
+    ass(Instructions.EQ)
+    assembler.pushrel(loop)
+    ass(Instructions.JUMPZ)
+    for _ in range(pushes):
+        assembler.push(1)
+    assembler.push(marker)
+    ass(Instructions.RET)
+    return state
+
+def make_caller(n):
+    '''
+    Make a State that makes `n` calls to a subroutine that returns at once.
+    '''
+    state = State(memory_words=1024)
+    assembler = Assembler(state)
+    ass = assembler.instruction
+    subroutine = state.M.start + 0x100
+    assembler.push(n)
+    loop = assembler.label()
+    assembler.push(0)
+    assembler.push(0)
+    assembler.pushrel(subroutine)
+    ass(Instructions.CALL)
+    assembler.push(-1)
+    ass(Instructions.ADD)
+    assembler.push(0)
+    ass(Instructions.DUP)
+    assembler.push(0)
+    ass(Instructions.EQ)
+    assembler.pushrel(loop)
+    ass(Instructions.JUMPZ)
+    ass(Instructions.RET)
+    assembler.goto(subroutine)
+    ass(Instructions.RET)
+    return state
+
+# Each thread has its own frames for calls, even without thread-local
+# storage, so States with the same settings can always run in threads.
+errors = []
+def run_caller(state):
+    try:
+        state.run()
+    except Exception as e:
+        errors.append(e)
+threads = [
+    threading.Thread(target=run_caller, args=(make_caller(100000),))
+    for _ in range(4)
+]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+if len(errors) != 0:
+    error(f"calls in threads raised {errors[0]!r}")
+print("Made calls in threads")
+
+run_fn_names = ['simple', 'cached', 'super', 'verified', 'guarded', 'count']
+
+# Run States with different engines and stack sizes in parallel.
+states = [
+    make_state(
+        100000,
+        i,
+        pushes=i,
+        run_fn=run_fn_names[i % len(run_fn_names)],
+        stack_words=8 + i,
+    )
+    for i in range(16)
+]
+# A State whose stack is too small.
+small = make_state(10, 99, pushes=8, stack_words=4)
+states.append(small)
+results = dict(run_threads(states, max_workers=8))
+for i, state in enumerate(states[:-1]):
+    if results[state] is not None:
+        error(f"run {i} raised {results[state]!r}")
+    correct = [0] + [1] * i + [i]
+    if state.stack.tolist() != correct:
+        error(f"stack of run {i} is {state.stack.tolist()}; expected {correct}")
+if not (
+    isinstance(results[small], VMError) and
+    results[small].args[0] == MitErrorCode.STACK_OVERFLOW
+):
+    error(f"run with too small a stack raised {results[small]!r}")
+print(f"Ran {len(states)} States in threads")
+
+# The calling thread's variables are unchanged.
+if stack_words.value != 32:
+    error(f"mit_stack_words was changed to {stack_words.value}")
+main_run_fn = run_ptr.contents
+if addressof(main_run_fn) != addressof(run_simple):
+    error("mit_run was changed")
+
+# The remaining tests need each thread to have its own variables.
+if not thread_local:
+    print("libmit has no thread-local storage: skipping the remaining tests")
+    sys.exit(77)
+
+# Step States in other threads, which use their own break variables.
+def step(state):
+    state.step(n=3)
+    return state.pc
+
+state = make_state(10, 0)
+offset = step(state) - state.M.start
+with ThreadPoolExecutor(4) as executor:
+    states = [make_state(10, i) for i in range(4)]
+    for state, pc in zip(states, executor.map(step, states)):
+        if pc != state.M.start + offset:
+            error(f"step stopped at pc={pc:#x}")
+print("Stepped States in threads")
+
+# A `break_fn` is per-State.
+calls = []
+def break_fn(pc, ir, stack, stack_words, stack_depth):
+    calls.append(pc)
+    return MitErrorCode.OK
+state = make_state(3, 0, run_fn=run_break)
+state.break_fn = break_fn
+state.run()
+if len(calls) == 0:
+    error("break_fn was not called")
+calls.clear()
+make_state(3, 0, run_fn=run_break).run()
+if len(calls) != 0:
+    error("break_fn of another State was called")
+
+# Compare running in one thread and in several.
+n = 4000000
+states = [make_state(n, 0, run_fn='cached') for _ in range(4)]
+start = time.perf_counter()
+for state in states:
+    state.run()
+serial = time.perf_counter() - start
+start = time.perf_counter()
+for _ in run_threads(states, max_workers=len(states)):
+    pass
+parallel = time.perf_counter() - start
+print(f"{len(states)} runs: {serial:.3f}s serially, {parallel:.3f}s in threads")
+
+print("threads tests ran OK")
@@ -0,0 +1,78 @@
+# Test the trace recorder.
+#
+# (c) Mit authors 2020
+#
+# The package is distributed under the MIT/X11 License.
+#
+# THIS PROGRAM IS PROVIDED AS IS, WITH NO WARRANTY. USE IS AT THE USER’S
+# RISK.
+
+import sys
+from ctypes import sizeof
+
+from mit.globals import *
+from mit.binding import run_trace
+
+
+# Test code
+goto(M.start)
+push(3)
+loop = label()
+push(-1)
+ass(ADD)
+push(0)
+ass(DUP)
+pushrel(loop)
+ass(JUMPZ)
+ass(POP)
+ass(RET)
+
+# Record the state before each instruction with `step()`.
+correct = []
+def record(handler, stack):
+    top = list(reversed(stack))[:2]
+    correct.append((
+        handler.state.pc,
+        handler.state.ir,
+        handler.state.ir & 0xff,
+        len(stack),
+        top + [0] * (2 - len(top)),
+    ))
+VM.pc = M.start
+step(n=1000, step_callback=record)
+print(f"{len(correct)} instructions stepped")
+
+def observed_trace():
+    return [
+        (entry.pc, entry.ir, entry.opcode, entry.depth, list(entry.stack))
+        for entry in VM.trace_records()
+    ]
+
+def check(name, observed, correct):
+    if observed != correct:
+        print(f"Error in trace tests: {name}")
+        print(f"Observed: {observed}")
+        print(f"Correct: {correct}")
+        sys.exit(1)
+
+# Trace the whole run.
+VM.start_trace()
+VM.pc = M.start
+run(run_fn=run_trace)
+check('whole trace', observed_trace(), correct)
+check('buffer protocol', memoryview(VM.trace_records()).nbytes,
+      len(correct) * sizeof(VM.trace_records()._type_))
+
+# Trace into a buffer that wraps around.
+VM.start_trace(3) # Rounded up to 4.
+VM.pc = M.start
+run(run_fn=run_trace)
+check('wrapped trace', observed_trace(), correct[-4:])
+
+# Stop tracing.
+VM.stop_trace()
+VM.pc = M.start
+run(run_fn=run_trace)
+check('stopped trace', observed_trace(), correct[-4:])
+
+print("Trace tests ran OK")
@@ -0,0 +1,95 @@
+# Test the verified-code interpreter.
+#
+# (c) Mit authors 2020
+#
+# The package is distributed under the MIT/X11 License.
+#
+# THIS PROGRAM IS PROVIDED AS IS, WITH NO WARRANTY. USE IS AT THE USER’S
+# RISK.
+
+import sys
+
+from mit.globals import *
+from mit.binding import run_simple, run_verified, verified_length
+
+from mit_test import Results
+
+
+# Results are stored in consecutive words from `results.addr`, which is
+# close enough to the code to be addressed with `pushreli`.
+results = Results(assembler, M.start + 0x100)
+store_result = results.store
+
+# Data
+data = M.start + 0x180
+M_word[data] = 0x1234
+
+# Code
+goto(M.start)
+
+# Arithmetic and stack manipulation.
+push(3)
+push(4)
+ass(ADD)
+push(2)
+ass(MUL)
+store_result(14)
+
+push(1)
+push(2)
+push(0)
+ass(SWAP)
+ass(POP)
+store_result(2)
+
+# Load a word at a constant address.
+pushrel(data)
+ass(LOAD)
+store_result(0x1234)
+
+# A conditional jump to a constant address.
+push(0)
+pushrel(M.start + 0xc0)
+ass(JUMPZ)
+goto(M.start + 0xc0)
+push(5)
+store_result(5)
+
+ass(RET)
+code_end = assembler.pc
+
+# Test
+code_words = (code_end - M.start) // word_bytes
+table = VM.verify(M.start, code_words)
+verified_words = [word for word in table if word.pops != uword_max]
+print(f"{len(verified_words)} of {code_words} words verified")
+if len(verified_words) == 0:
+    print("Error in verified code tests: no words verified")
+    sys.exit(1)
+
+results.check('verified code', (run_simple, run_verified), M.start)
+
+# Change the code after verifying it: the changed word must run with checks.
+first_word = M_word[M.start]
+assert first_word & 0xff == 0x1b # pushi_3
+M_word[M.start] = first_word & ~0xff | 0x53 # pushi_10
+results.correct[0] = 28
+results.check('verified code', (run_verified,), M.start)
+
+# Changed code that underflows the stack must be caught.
+M_word[M.start] = first_word & ~0xff | DUP
+try:
+    results.run(run_verified, M.start)
+    print("Error in verified code tests: stack underflow not caught")
+    sys.exit(1)
+except VMError as e:
+    if e.args[0] != MitErrorCode.INVALID_STACK_READ:
+        print(f"Error in verified code tests: error {e.args[0]} returned")
+        sys.exit(1)
+
+# The verified code is only used while VM is running.
+if verified_length.value != 0:
+    print("Error in verified code tests: verified code left set after run")
+    sys.exit(1)
+
+print("Verified code tests ran OK")
@@ -0,0 +1,80 @@
+# Test watchpoints.
+#
+# (c) Mit authors 2020
+#
+# The package is distributed under the MIT/X11 License.
+#
+# THIS PROGRAM IS PROVIDED AS IS, WITH NO WARRANTY. USE IS AT THE USER’S
+# RISK.
+
+import sys
+
+from mit.globals import *
+from mit.binding import run_watch
+
+
+# Data
+watched = M.start + 0x1000
+unwatched = watched + word_bytes
+M_word[watched] = 1
+M_word[unwatched] = 2
+
+# Code: write to the unwatched word, then twice to the watched word.
+goto(M.start)
+push(20)
+push(unwatched)
+ass(STORE)
+push(10)
+push(watched)
+ass(STORE)
+store1_end = label()
+push(11)
+push(watched)
+ass(STORE)
+ass(RET)
+
+failures = 0
+def check(name, observed, correct):
+    global failures
+    print(f'{name}: {observed}')
+    if observed != correct:
+        print(f'Error in watch tests: {name} should be {correct}')
+        failures += 1
+
+VM.watch([watched], max_hits=1)
+VM.pc = M.start
+run(run_fn=run_watch)
+hits, count = VM.watch_hits()
+check('Hit count', count, 2)
+check('Hits recorded', len(hits), 1)
+check('Hit', (hits[0].addr, hits[0].old_value, hits[0].new_value), (watched, 1, 10))
+check('Hit pc', hits[0].pc, store1_end)
+check('Memory', (M_word[watched], M_word[unwatched]), (11, 20))
+
+# The watched memory can be written from Python between runs.
+M_word[watched] = 0
+check('Memory written from Python', M_word[watched], 0)
+
+# Unwatch, and run again.
+VM.unwatch()
+VM.pc = M.start
+run(run_fn=run_watch)
+check('Hit count after unwatch', VM.watch_hits()[1], 2)
+
+# Only pages of M can be watched, as the whole page is protected.
+def check_refused(name, state, addr):
+    try:
+        state.watch([addr])
+        check(name, 'watched', 'refused')
+    except Error:
+        check(name, 'refused', 'refused')
+
+check_refused('Address outside M', VM, M.end)
+small_state = State(memory=bytearray(2 * word_bytes))
+check_refused('Memory smaller than a page', small_state, small_state.M.start)
+VM.unwatch()
+
+if failures != 0:
+    sys.exit(1)
+
+print("Watch tests ran OK")